@@ -0,0 +1,91 @@
+import gzip
+import lzma
+import json
+import os
+import glob
+import logging
+
+
+def summarize(year, records):
+    hours = {}
+    punches = 0
+    for dateStr, dayRecords in sorted(records.items()):
+        prevTime = None
+        for time, chargeNumber in sorted(dayRecords.items(), key=lambda x: float(x[0])):
+            punches += 1
+            if prevTime is not None and str(chargeNumber) != "0":
+                hours[str(chargeNumber)] = hours.get(str(chargeNumber), 0) + \
+                    (float(time) - prevTime) / 60.0 / 60.0
+            prevTime = float(time)
+    return {'year': year,
+            'days': sorted(records.keys()),
+            'punches': punches,
+            'hours': hours}
+
+
+class ArchiveStore():
+    COMPRESSION = {'gzip': ('.json.gz', gzip),
+                   'lzma': ('.json.xz', lzma)}
+
+    def __init__(self, path, compression='gzip'):
+        assert(compression in self.COMPRESSION)
+        self.__log = logging.getLogger("chargeNumberTracker.ArchiveStore")
+        self.path = path
+        self.compression = compression
+        self.__summaries = None
+
+    def __summaryPath(self, year):
+        return os.path.join(self.path, '%d.summary.json' % (year))
+
+    def __shardPath(self, year):
+        for extension, _ in self.COMPRESSION.values():
+            shardPath = os.path.join(self.path, '%d%s' % (year, extension))
+            if os.path.isfile(shardPath):
+                return shardPath
+        return None
+
+    def summaries(self):
+        if self.__summaries is None:
+            self.__summaries = {}
+            for summaryPath in glob.glob(os.path.join(self.path, '*.summary.json')):
+                with open(summaryPath, 'r') as file:
+                    summary = json.load(file)
+                self.__summaries[int(summary['year'])] = summary
+        return self.__summaries
+
+    def years(self):
+        return sorted(self.summaries().keys())
+
+    def summary(self, year):
+        return self.summaries()[year]
+
+    def read(self, year):
+        # Returns the payload given to write, without 'year'
+        self.__log.info("Decompressing %d" % (year))
+        shardPath = self.__shardPath(year)
+        for extension, module in self.COMPRESSION.values():
+            if shardPath.endswith(extension):
+                with module.open(shardPath, 'rt') as file:
+                    payload = json.load(file)
+                payload.pop('year', None)
+                return payload
+
+    def write(self, year, payload):
+        # payload holds 'records' and any other per-day data such as 'zones'
+        self.__log.info("Archiving %d" % (year))
+        if not os.path.isdir(self.path):
+            os.mkdir(self.path)
+        extension, module = self.COMPRESSION[self.compression]
+        shardPath = os.path.join(self.path, '%d%s' % (year, extension))
+        oldShardPath = self.__shardPath(year)
+        with module.open(shardPath + '.tmp', 'wt') as file:
+            json.dump(dict(payload, year=year), file)
+        os.replace(shardPath + '.tmp', shardPath)
+        if oldShardPath is not None and oldShardPath != shardPath:
+            os.remove(oldShardPath)
+
+        summary = summarize(year, payload['records'])
+        with open(self.__summaryPath(year) + '.tmp', 'w') as file:
+            json.dump(summary, file, indent=4, sort_keys=True)
+        os.replace(self.__summaryPath(year) + '.tmp', self.__summaryPath(year))
+        self.summaries()[year] = summary
@@ -0,0 +1,126 @@
+import numpy as np
+import datetime as dt
+
+
+class BillingRules():
+    ROUND_NEAREST = 'nearest'
+    ROUND_UP = 'up'
+    ROUND_DOWN = 'down'
+    ROUNDING_MODES = (ROUND_NEAREST, ROUND_UP, ROUND_DOWN)
+
+    PER_DAY = 'day'
+    PER_PERIOD = 'period'
+    SCOPES = (PER_DAY, PER_PERIOD)
+
+    FIELDS = ('increment', 'rounding', 'scope', 'periodDays', 'periodStart',
+              'minimumCharge', 'nonBillable')
+
+    def __init__(self, increment=0.25, rounding=ROUND_NEAREST, scope=PER_DAY,
+                 periodDays=7, periodStart=dt.date(2019, 12, 9),
+                 minimumCharge=0.0, nonBillable=()):
+        assert(increment > 0)
+        assert(rounding in self.ROUNDING_MODES)
+        assert(scope in self.SCOPES)
+        assert(periodDays > 0)
+        self.increment = float(increment)
+        self.rounding = rounding
+        self.scope = scope
+        self.periodDays = int(periodDays)
+        self.periodStart = periodStart
+        self.minimumCharge = float(minimumCharge)
+        self.nonBillable = frozenset(str(cn) for cn in nonBillable)
+
+    @classmethod
+    def fromDict(cls, data):
+        # Keys written by newer versions are ignored
+        kwargs = {key: value for key, value in data.items() if key in cls.FIELDS}
+        if 'periodStart' in kwargs:
+            kwargs['periodStart'] = dt.datetime.strptime(
+                kwargs['periodStart'], '%Y-%m-%d').date()
+        return cls(**kwargs)
+
+    def toDict(self):
+        return {'increment': self.increment,
+                'rounding': self.rounding,
+                'scope': self.scope,
+                'periodDays': self.periodDays,
+                'periodStart': self.periodStart.isoformat(),
+                'minimumCharge': self.minimumCharge,
+                'nonBillable': sorted(self.nonBillable)}
+
+    def isBillable(self, project):
+        return project.isBillable and \
+            project.chargeNumber not in self.nonBillable
+
+    def releaseOffset(self):
+        # How early one can stop and still have the day round up to target
+        if self.rounding == self.ROUND_NEAREST:
+            hours = self.increment / 2
+        elif self.rounding == self.ROUND_UP:
+            hours = self.increment - 1 / 3600.0
+        else:
+            hours = 0
+        return dt.timedelta(hours=hours)
+
+    def periodIndex(self, dates):
+        if self.scope == self.PER_DAY:
+            return np.arange(len(dates))
+        ordinals = np.fromiter((date.toordinal() for date in dates),
+                               dtype=np.int64, count=len(dates))
+        return (ordinals - self.periodStart.toordinal()) // self.periodDays
+
+    def periodDates(self, date):
+        if self.scope == self.PER_DAY:
+            return [date]
+        offset = (date - self.periodStart).days % self.periodDays
+        start = date - dt.timedelta(days=offset)
+        return [start + dt.timedelta(days=i) for i in range(self.periodDays)]
+
+    def round(self, hours):
+        units = np.asarray(hours, dtype=np.float64) / self.increment
+        if self.rounding == self.ROUND_NEAREST:
+            units = np.round(units)
+        elif self.rounding == self.ROUND_UP:
+            # Guard against float noise pushing exact multiples up a step
+            units = np.ceil(np.round(units, 9))
+        else:
+            units = np.floor(np.round(units, 9))
+        return units * self.increment
+
+    def apply(self, hours, billable, dates):
+        # hours is a projects x days matrix of raw hours, billable a per
+        # project mask, dates the ascending dates of the columns
+        hours = np.asarray(hours, dtype=np.float64)
+        billable = np.asarray(billable, dtype=bool)
+        assert(hours.ndim == 2)
+        assert(hours.shape == (len(billable), len(dates)))
+        hours = np.where(billable[:, np.newaxis], hours, 0.0)
+        if self.minimumCharge > 0:
+            hours = np.where(hours > 0, np.maximum(hours, self.minimumCharge),
+                             hours)
+        if self.scope == self.PER_DAY or hours.shape[1] == 0:
+            return self.round(hours)
+
+        # Round the running total within each period, so that each period
+        # sums to its rounded total while the days stay individually visible
+        periods = self.periodIndex(dates)
+        _, firstIdx, inverse = np.unique(periods, return_index=True,
+                                         return_inverse=True)
+        groupStart = firstIdx[inverse]
+        cumulative = np.cumsum(hours, axis=1)
+        padded = np.concatenate(
+            (np.zeros((hours.shape[0], 1)), cumulative), axis=1)
+        periodCumulative = self.round(cumulative - padded[:, groupStart])
+        previous = np.concatenate(
+            (np.zeros((hours.shape[0], 1)), periodCumulative[:, :-1]), axis=1)
+        previous[:, groupStart == np.arange(len(dates))] = 0
+        return periodCumulative - previous
+
+    def billableHours(self, project, date):
+        dates = self.periodDates(date)
+        row = np.array([[project.hours.get(d, 0.0) for d in dates]])
+        return float(self.apply(row, [self.isBillable(project)],
+                                dates)[0, dates.index(date)])
+
+
+DEFAULT_RULES = BillingRules()
@@ -0,0 +1,87 @@
+import bisect
+import collections
+import timeZones
+
+Charge = collections.namedtuple('Charge', ['date', 'intervals', 'hours'])
+
+
+class ChargeIndex():
+    # Inverted index chargeNumber -> sorted dates -> intervals charged that
+    # day.  As in records.dayHours, the time since the previous punch goes
+    # to the later punch's charge number.
+    def __init__(self):
+        self.dates = {}
+        self.intervals = {}
+        self.dayCharges = {}
+        self.dayZones = {}
+
+    def rebuild(self, days):
+        self.dates = {}
+        self.intervals = {}
+        self.dayCharges = {}
+        self.dayZones = {}
+        charged = {}
+        for date, dayRecord in sorted(days):
+            self.dayZones[date] = dayRecord.zone
+            for chargeNumber, intervals in self.__dayIntervals(dayRecord).items():
+                charged.setdefault(chargeNumber, []).append((date, intervals))
+            self.dayCharges[date] = set()
+        # Days arrive sorted, so each list is built without insertion
+        for chargeNumber, entries in charged.items():
+            self.dates[chargeNumber] = [date for date, _ in entries]
+            self.intervals[chargeNumber] = dict(entries)
+            for date, _ in entries:
+                self.dayCharges[date].add(chargeNumber)
+
+    def __dayIntervals(self, dayRecord):
+        intervals = {}
+        punches = dayRecord.epochItems()
+        for (start, _), (end, project) in zip(punches, punches[1:]):
+            intervals.setdefault(project.chargeNumber, []).append((start, end))
+        return intervals
+
+    def updateDay(self, date, dayRecord):
+        for chargeNumber in self.dayCharges.pop(date, ()):
+            dates = self.dates[chargeNumber]
+            del dates[bisect.bisect_left(dates, date)]
+            del self.intervals[chargeNumber][date]
+        if dayRecord is None:
+            return
+        self.dayZones[date] = dayRecord.zone
+        self.dayCharges[date] = set()
+        for chargeNumber, intervals in self.__dayIntervals(dayRecord).items():
+            bisect.insort(self.dates.setdefault(chargeNumber, []), date)
+            self.intervals.setdefault(chargeNumber, {})[date] = intervals
+            self.dayCharges[date].add(chargeNumber)
+
+    def updateDays(self, days):
+        for date, dayRecord in days:
+            self.updateDay(date, dayRecord)
+
+    def chargeNumbers(self):
+        return sorted(chargeNumber for chargeNumber, dates in self.dates.items()
+                      if len(dates) > 0)
+
+    def __range(self, chargeNumber, start, end):
+        dates = self.dates.get(chargeNumber, [])
+        first = 0 if start is None else bisect.bisect_left(dates, start)
+        last = len(dates) if end is None else bisect.bisect_right(dates, end)
+        return dates[first:last]
+
+    def query(self, chargeNumber, start=None, end=None):
+        # Every day chargeNumber was charged between start and end
+        # inclusive, with its (start, end) datetimes and total hours
+        charges = []
+        for date in self.__range(chargeNumber, start, end):
+            intervals = self.intervals[chargeNumber][date]
+            zone = self.dayZones.get(date)
+            charges.append(Charge(
+                date, [(timeZones.toLocal(begin, zone), timeZones.toLocal(finish, zone))
+                       for begin, finish in intervals],
+                sum(finish - begin for begin, finish in intervals) / 3600e6))
+        return charges
+
+    def totalHours(self, chargeNumber, start=None, end=None):
+        return sum(finish - begin
+                   for date in self.__range(chargeNumber, start, end)
+                   for begin, finish in self.intervals[chargeNumber][date]) / 3600e6
@@ -49,26 +49,53 @@ import os
 import tkcalendar as tkc
 from tkinter import messagebox as tkMessageBox
 import operator
+import collections
+import functools
 import dataStore
-import subprocess
-import shlex
+import submission
+import eventBus
+import profiling
+import logConfig
+import syncStore
+import liveSnapshot
+import chargeIndex
+import timeZones
+import argparse
 from tkinter import filedialog as tkf
 import traceback
 import glob
 import logging
 import sys
+import queue
+import threading
+from tkinter import ttk
+import billingRules
+import ledger
+import archive
+import records
 
 test = True
 
 
+def synchronized(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
 class Project():
+    __slots__ = ('__log', 'name', 'chargeNumber', 'hours', 'isBillable',
+                 'sortIdx')
+
     def __init__(self, name, chargeNumber, isBillable, sortIdx=-1):
         self.__log = logging.getLogger(
             "chargeNumberTracker.Project(%s)" % (chargeNumber))
         self.__log.info("Created")
         self.name = name
         self.chargeNumber = chargeNumber
-        self.hours = {}
+        self.hours = records.MonthHours()
         self.isBillable = isBillable
         if sortIdx == -1:
             self.sortIdx = 999
@@ -78,6 +105,7 @@ class Project():
     def addHours(self, hours, date):
         assert(isinstance(hours, float) or isinstance(hours, dt.timedelta))
         self.__log.info("Adding hours")
+        date = records.internDate(date)
         if date not in self.hours:
             self.hours[date] = 0
         if isinstance(hours, float):
@@ -88,37 +116,211 @@ class Project():
     def setHours(self, hours, date):
         assert(isinstance(hours, float) or isinstance(hours, dt.timedelta))
         self.__log.info("Setting total hours")
+        date = records.internDate(date)
         if isinstance(hours, float):
             self.hours[date] = hours
         elif isinstance(hours, dt.timedelta):
             self.hours[date] = hours.total_seconds() / 60.0 / 60.0
 
-    def getBillableHours(self, date):
+    def getBillableHours(self, date, rules=billingRules.DEFAULT_RULES):
         self.__log.info("Retrieving total hours")
-        if not self.isBillable:
-            return 0
-        if date in self.hours:
-            return np.round(self.hours[date] * 4) / 4
-        else:
-            return 0
+        return rules.billableHours(self, date)
 
     def __str__(self):
         return "{%s(%s): %s}" % (self.name, self.chargeNumber, self.hours)
 
 
-class HourTracker():
+class Edit(collections.namedtuple('Edit', ['time', 'oldProject', 'newProject'])):
+    __slots__ = ()
+
+    def inverse(self):
+        return Edit(self.time, self.newProject, self.oldProject)
+
+
+class Transaction():
+    # Changes that are not the user's own, such as sync merges, are not
+    # undoable and drop the undo history they would invalidate
+    def __init__(self, hourTracker, undoable=True):
+        self.hourTracker = hourTracker
+        self.undoable = undoable
+        self.edits = []
+        self.dates = set()
+        self.createdDates = set()
+        self.done = False
+
+    def __enter__(self):
+        # Held until commit or rollback so readers never see half an edit
+        self.hourTracker.lock.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tbk):
+        try:
+            if exc_type is None:
+                self.commit()
+            else:
+                self.rollback()
+        finally:
+            self.hourTracker.lock.release()
+
+    def __current(self, time):
+        dayRecord = self.hourTracker.timeRecord.get(time.date())
+        if dayRecord is None:
+            return None
+        return dayRecord.get(time)
+
+    def __apply(self, *edits):
+        assert(not self.done)
+        self.createdDates.update(edit.time.date() for edit in edits
+                                 if edit.time.date() not in self.hourTracker.timeRecord)
+        self.dates.update(self.hourTracker.applyEdits(edits))
+        self.edits.extend(edits)
+
+    def insert(self, time, project):
+        self.__apply(Edit(time, self.__current(time), project))
+
+    def delete(self, time):
+        project = self.__current(time)
+        if project is None:
+            raise KeyError(time)
+        self.__apply(Edit(time, project, None))
+
+    def changeChargeNumber(self, time, project):
+        oldProject = self.__current(time)
+        if oldProject is None:
+            raise KeyError(time)
+        self.__apply(Edit(time, oldProject, project))
+
+    def movePunch(self, time, newTime):
+        project = self.__current(time)
+        if project is None:
+            raise KeyError(time)
+        self.__apply(Edit(time, project, None))
+        self.__apply(Edit(newTime, self.__current(newTime), project))
+
+    def commit(self):
+        assert(not self.done)
+        self.done = True
+        if len(self.edits) == 0:
+            return
+        self.hourTracker.commitEdits(self.edits, self.dates)
+        if self.undoable:
+            self.hourTracker.pushUndo(self.edits)
+        else:
+            self.hourTracker.clearUndo()
+
+    def rollback(self):
+        assert(not self.done)
+        self.done = True
+        self.hourTracker.applyEdits(
+            [edit.inverse() for edit in reversed(self.edits)])
+        # Days the edits created would otherwise be saved empty
+        for date in self.createdDates:
+            self.hourTracker.timeRecord.discardDay(date)
+
+
+def hoursMatrix(dates, projects, projectHours):
+    hours = np.zeros((len(projects), len(dates)))
+    for row, project in enumerate(projects):
+        dayHours = projectHours[project]
+        for col, date in enumerate(dates):
+            if date in dayHours:
+                hours[row, col] = dayHours[date]
+    return hours
+
+
+class HourQueries():
+    # Derived hours shared by the tracker and its snapshots, both provide
+    # projects, dailyHours, prevTime, billingRules and getHoursMatrix
+    def getTodayTotalHours(self):
+        date = dt.datetime.now().date()
+        totalHours = 0
+        projectHours = self.getHours(date)
+        for chargeNumber, hours in projectHours.items():
+            totalHours += hours
+        return totalHours
+
+    def getTodayRemainingHours(self):
+        return self.dailyHours - self.getTodayTotalHours()
+
+    def getEarliestReleaseTime(self):
+        if self.prevTime.date() != dt.datetime.now().date():
+            return dt.datetime.now() + \
+                dt.timedelta(hours=self.getTodayRemainingHours()) - \
+                self.billingRules.releaseOffset()
+        return self.prevTime + \
+            dt.timedelta(hours=self.getTodayRemainingHours()) - \
+            self.billingRules.releaseOffset()
+
+    def getBillableMatrix(self, dates, projects=None):
+        if projects is None:
+            projects = self.projects
+        billable = [self.billingRules.isBillable(
+            project) for project in projects]
+        return self.billingRules.apply(self.getHoursMatrix(dates, projects),
+                                       billable, dates)
+
+    def getHours(self, date):
+        dates = self.billingRules.periodDates(date)
+        billed = self.getBillableMatrix(dates)[:, dates.index(date)]
+        return {project.chargeNumber: float(hours)
+                for project, hours in zip(self.projects, billed)}
+
+
+class TrackerSnapshot(HourQueries):
+    # Read-only copy of the tracker state at one instant, safe to read from
+    # any thread.  Day records are shared with the tracker, which replaces
+    # rather than changes a day once it may be shared.  Project hours share
+    # their month maps, copied by the tracker before it next changes them
+    def __init__(self, hourTracker):
+        self.projects = list(hourTracker.projects)
+        self.projectHours = {project: project.hours.freeze()
+                             for project in self.projects}
+        self.days = dict.copy(hourTracker.timeRecord)
+        self.days.update(hourTracker.timeRecord.archivedDays)
+        self.prevTime = hourTracker.prevTime
+        self.dailyHours = hourTracker.dailyHours
+        self.billingRules = hourTracker.billingRules
+        self.arriveProject = hourTracker.arriveProject
+        self.complete = hourTracker.timeRecord.isComplete()
+        self.zone = hourTracker.timeRecord.zone
+
+    def getHoursMatrix(self, dates, projects=None):
+        if projects is None:
+            projects = self.projects
+        return hoursMatrix(dates, projects, self.projectHours)
+
+
+class HourTracker(HourQueries):
+    # Concurrency: every change to timeRecord, project hours or prevTime is
+    # made while holding self.lock, a transaction holds it from start to
+    # commit.  The GUI thread may read the tracker directly, other threads
+    # read a TrackerSnapshot from snapshot() instead
     NUM_BACKUPS = 4
 
     def __init__(self, path):
         self.__log = logging.getLogger("chargeNumberTracker.HourTracker")
         self.__log.info("Created")
+        self.dataDir = path
         self.path = os.path.join(path, 'data.json')
+        self.archivePath = os.path.join(path, 'archive')
         self.start = None
         self.prevTime = dt.datetime.fromtimestamp(0)
         self.arriveProject = None
-        self.addProjectCallback = []
-        self.addHoursCallback = []
+        self.events = eventBus.EventBus()
         self.dailyHours = 0
+        self.undoStack = []
+        self.redoStack = []
+        self.settings = {}
+        self.billingRules = billingRules.DEFAULT_RULES
+        self.historyQueue = None
+        self.historyTotal = 0
+        self.historyDates = set()
+        self.historyProjects = set()
+        self.historyErrors = []
+        self.ledgerComplete = False
+        self.ledgerSummaryYears = set()
+        self.lock = threading.RLock()
+        self.publisher = None
 
     def open(self):
         self.__log.debug("Open")
@@ -128,51 +330,217 @@ class HourTracker():
         self.__log.debug("Close")
         self.__exit__(None, None, None)
 
+    def openCurrent(self):
+        # Only this month's records are decoded, the rest of the history is
+        # read by startHistoryLoad or on first access
+        self.__log.debug("Open current month")
+        self.__load([records.monthKey(dt.datetime.today().date())])
+
     def __enter__(self):
         self.__log.info("Initializing resources")
-        if os.path.isfile(self.path):
-            with open(self.path, 'r') as file:
-                data = json.load(file)
-        else:
+        self.__load(None)
+
+    @synchronized
+    def __load(self, months):
+        if not os.path.isfile(self.path):
             self.__log.info("New data store")
-            data = {}
-        data = dataStore.fromDict(data)
+        records.resetProjects()
+        data = dataStore.load(self.dataDir, months)
         self.dailyHours = data['dailyHours']
         self.projects = data['projects']
-        self.timeRecord = data['timeRecord']
         self.prevTime = data['prevTime']
         self.arriveProject = data['arriveProject']
         self.recordHoursPath = data['recordHoursPath']
+        self.settings = data.get('settings', {})
+        self.billingRules = billingRules.BillingRules.fromDict(
+            self.settings.get('billing', {}))
+        archiveSettings = self.settings.get('archive', {})
+        self.timeRecord = records.TimeRecord(
+            data['timeRecord'],
+            archive=archive.ArchiveStore(self.archivePath,
+                                         archiveSettings.get('compression', 'gzip')),
+            loader=self.__loadArchivedDays, serializer=dataStore.serializeArchive,
+            unloadedMonths=data['unloadedMonths'], monthLoader=self.__loadMonth,
+            lock=self.lock,
+            zone=self.settings.get('timeZone') or timeZones.systemZone())
+        self.chargeIndex = chargeIndex.ChargeIndex()
+        self.chargeIndex.rebuild(dict.items(self.timeRecord))
+        self.timeRecord.changedDates = {
+            dt.date.fromisoformat(dateStr) for dateStr
+            in self.settings.get('sync', {}).get('pending', [])}
+        if data['version'] >= 2.2:
+            self.timeRecord.markClean()
+        else:
+            self.__log.info("Migrating to month shards")
+        self.ledger = ledger.BalanceLedger.fromDict(
+            self.settings.get('flex', {}), self.dailyHours, self.billingRules,
+            start=self.getFirstDate())
+        self.rebuildLedger(load=months is None)
+        if self.settings.setdefault('snapshot', {'enabled': True})['enabled'] and \
+                self.publisher is None:
+            self.publisher = liveSnapshot.SnapshotPublisher(
+                os.path.join(self.dataDir, liveSnapshot.FILE_NAME))
+        if self.timeRecord.isComplete():
+            self.archiveClosedYears()
+        self.publishSnapshot()
 
     def __exit__(self, exc_type, exc_value, tbk):
         self.__log.info("Closing resources")
         self.flush()
-
+        if self.publisher is not None:
+            self.publisher.close()
+            self.publisher = None
+
+    def __loadArchivedDays(self, payload):
+        projectMap = {project.chargeNumber: project for project in self.projects}
+        days = dataStore.deserializeDays(payload['records'], projectMap,
+                                         payload.get('zones'))
+        for date, dayRecord in days.items():
+            self.__updateProjectHours(date, dayRecord)
+        self.chargeIndex.updateDays(days.items())
+        return days
+
+    def __loadMonth(self, month):
+        projectMap = {project.chargeNumber: project for project in self.projects}
+        days, hours = dataStore.loadShard(self.dataDir, month, projectMap)
+        for project, projectHours, date in hours:
+            project.setHours(projectHours, date)
+        self.chargeIndex.updateDays(days.items())
+        return days
+
+    def startHistoryLoad(self):
+        months = sorted(self.timeRecord.unloadedMonths, reverse=True)
+        self.historyTotal = len(months)
+        if len(months) == 0:
+            return
+        self.__log.info("Loading %d months of history" % (len(months)))
+        projectMap = {project.chargeNumber: project for project in self.projects}
+        self.historyQueue = queue.Queue()
+        threading.Thread(target=self.__decodeHistory,
+                         args=(months, projectMap, self.historyQueue),
+                         daemon=True, name="HistoryLoader").start()
+
+    def __decodeHistory(self, months, projectMap, historyQueue):
+        for month in months:
+            try:
+                days, hours = dataStore.loadShard(self.dataDir, month, projectMap)
+                historyQueue.put((month, days, hours, None))
+            except Exception as e:
+                # Handed to the main thread, which reports it
+                self.__log.warning("Failed to decode %s: %s" % (month, e))
+                historyQueue.put((month, None, None, e))
+        historyQueue.put(None)
+
+    def isHistoryLoaded(self):
+        return self.timeRecord.isComplete()
+
+    def getHistoryProgress(self):
+        return self.historyTotal - len(self.timeRecord.unloadedMonths), self.historyTotal
+
+    @synchronized
+    def mergeHistory(self, maxMonths=1):
+        # Called from the GUI thread, merges up to maxMonths decoded months.
+        # Done only once the loader's end marker is seen, months loaded early
+        # on demand can complete the record before that.  Views are told
+        # once, when everything is merged.  A month that fails to decode is
+        # left unloaded, and unchanged on disk, and listed in historyErrors
+        while maxMonths > 0 and self.historyQueue is not None:
+            try:
+                item = self.historyQueue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self.historyQueue = None
+                if len(self.historyErrors) == 0:
+                    self.timeRecord.loadAll()
+                    self.archiveClosedYears()
+                self.rebuildLedger(load=self.timeRecord.isComplete())
+                self.events.publish(eventBus.DayRecomputed(
+                    frozenset(self.historyDates), frozenset(self.historyProjects)))
+                self.historyDates = set()
+                self.historyProjects = set()
+                self.publishSnapshot()
+                break
+            month, days, hours, error = item
+            maxMonths -= 1
+            # Months reached early were already loaded synchronously
+            if month not in self.timeRecord.unloadedMonths:
+                continue
+            if error is not None:
+                self.historyErrors.append((month, error))
+                continue
+            for project, projectHours, date in hours:
+                project.setHours(projectHours, date)
+            self.chargeIndex.updateDays(days.items())
+            self.timeRecord.loadMonth(month, days)
+            self.historyDates.update(days.keys())
+            self.historyProjects.update(project for dayRecord in days.values()
+                                        for _, project in dayRecord.epochItems())
+        return self.historyQueue is None
+
+    @synchronized
+    def archiveClosedYears(self):
+        archiveSettings = self.settings.setdefault(
+            'archive', {'keepYears': 1, 'compression': 'gzip'})
+        cutoff = dt.datetime.today().year - archiveSettings['keepYears']
+        closedYears = {date.year for date in dict.keys(self.timeRecord)
+                       if date.year < cutoff}
+        for year in sorted(closedYears):
+            self.__log.info("Archiving %d" % (year))
+            self.timeRecord.archiveYear(year)
+        if len(closedYears) > 0:
+            self.flush()
+
+    def getArchiveSummaries(self):
+        return {year: self.timeRecord.archive.summary(year)
+                for year in self.timeRecord.archivedYears()}
+
+    @synchronized
     def flush(self):
         self.__log.info("Flushing data")
-        data = dataStore.toDict(dailyHours=self.dailyHours,
-                                projects=self.projects, timeRecord=self.timeRecord,
-                                recordHoursPath=self.recordHoursPath)
-        existingBackups = glob.glob("%s.*" % (self.path))
-        existingBackupNums = [(backup, int(os.path.basename(
-            backup).split('.json.')[1])) for backup in existingBackups]
-        if len(existingBackups) >= self.NUM_BACKUPS:
-            os.remove(existingBackupNums[-1][0])
-            existingBackupNums = existingBackupNums[0:-1]
-        for backup, number in sorted(existingBackupNums, reverse=True, key=lambda x: x[1]):
-            os.rename(backup, "%s.%d" % (self.path, number + 1))
-        if os.path.isfile(self.path):
-            os.rename(self.path, "%s.%d" % (self.path, 0))
-        with open(self.path, 'w') as file:
-            json.dump(data, file, indent=4, sort_keys=True)
+        self.timeRecord.flushArchives()
+        self.settings['billing'] = self.billingRules.toDict()
+        self.settings['flex'] = self.ledger.toDict()
+        if self.settings.get('sync', {}).get('folder', '') != '':
+            self.settings['sync']['pending'] = sorted(
+                date.isoformat() for date in self.timeRecord.changedDates)
+        dataStore.save(self.dataDir, self.NUM_BACKUPS,
+                       dailyHours=self.dailyHours,
+                       projects=self.projects, timeRecord=self.timeRecord,
+                       recordHoursPath=self.recordHoursPath,
+                       settings=self.settings,
+                       months=self.timeRecord.dirtyMonths,
+                       unloadedMonths=self.timeRecord.unloadedMonths,
+                       removedMonths=self.timeRecord.removedMonths,
+                       compact=self.settings.get('storage', {}).get('compact', False))
+        self.timeRecord.markClean()
+        self.publishSnapshot()
+
+    @synchronized
+    def publishSnapshot(self):
+        # Written on the publisher's thread for external report tools
+        if self.publisher is not None:
+            self.publisher.publish(TrackerSnapshot(self))
 
     def registerAddProjectCallback(self, func):
         self.__log.debug("Adding AddProject callback")
-        self.addProjectCallback.append(func)
+        return self.events.subscribe(lambda event: func(event.project),
+                                     (eventBus.ProjectAdded,))
 
     def registerAddHoursCallback(self, func):
         self.__log.debug("Adding AddHours Callback")
-        self.addHoursCallback.append(func)
+        return self.events.subscribe(lambda event: func(event.project),
+                                     (eventBus.PunchAdded,))
+
+    def subscribe(self, func, eventTypes=eventBus.EVENT_TYPES, coalesce=None):
+        return self.events.subscribe(func, eventTypes, coalesce)
+
+    def notifySettingsChanged(self, *keys):
+        self.__log.info("Settings changed")
+        if 'billing' in keys or 'flex' in keys:
+            # While history is loading the merge rebuilds it at the end
+            self.rebuildLedger(load=self.historyQueue is None)
+        self.events.publish(eventBus.SettingsChanged(keys))
 
     def getProjectNames(self, includeArrival=False):
         self.__log.debug("Getting project names")
@@ -182,85 +550,296 @@ class HourTracker():
             return {project.name: project for project in self.projects
                     if project.chargeNumber != "0"}
 
+    @synchronized
+    def ensureProject(self, chargeNumber, name, isBillable, sortIdx=-1):
+        for project in self.projects:
+            if project.chargeNumber == chargeNumber:
+                return project
+        project = Project(name, chargeNumber, isBillable, sortIdx)
+        self.addProject(project)
+        return project
+
+    @synchronized
+    def sync(self):
+        self.__log.info("Synchronizing")
+        folder = self.settings.get('sync', {}).get('folder', '')
+        if folder == '':
+            return None
+        return syncStore.SyncStore(self.dataDir, folder).sync(self)
+
+    @synchronized
     def addProject(self, project):
         self.__log.debug("Adding project")
         self.projects.append(project)
-        for func in self.addProjectCallback:
-            func(project)
+        self.events.publish(eventBus.ProjectAdded(project))
 
-    def __today(self):
+    def __today(self, date):
         self.__log.debug("Getting today's records")
-        return self.timeRecord[dt.datetime.today().date()]
-
-    def recordArrive(self, time=dt.datetime.now()):
+        if date not in self.timeRecord:
+            raise KeyError(date)
+        return self.timeRecord.mutableDay(date)
+
+    def __now(self):
+        # The current instant, the day it falls on and its key in the zone
+        # that day is kept in, whatever zone the machine is in now
+        epoch = timeZones.nowEpoch()
+        date = timeZones.toLocal(epoch, self.timeRecord.zone).date()
+        dayRecord = self.timeRecord.get(date)
+        zone = self.timeRecord.zone if dayRecord is None else dayRecord.zone
+        return epoch, date, timeZones.toLocal(epoch, zone)
+
+    @synchronized
+    def recordArrive(self, time=None):
         self.__log.info("Recording arrival")
+        if time is None:
+            _, _, time = self.__now()
         self.start = time
         self.prevTime = self.start
-        self.timeRecord[dt.datetime.today().date()] = {}
-        self.__today()[self.start] = self.arriveProject
-        for func in self.addHoursCallback:
-            func(self.arriveProject)
+        # Arriving starts the day over, as one undoable edit so the hours,
+        # charge index and ledger follow
+        with self.transaction() as transaction:
+            for punch in list(self.timeRecord.get(time.date(), {}).keys()):
+                transaction.delete(punch)
+            transaction.insert(time, self.arriveProject)
+
+    def __updateProjectHours(self, date, dayRecord):
+        # Projects that no longer appear on this day are reset to zero
+        timeRef = {project: dt.timedelta() for project in self.projects
+                   if date in project.hours}
+        timeRef.update(records.dayHours(dayRecord))
+        for proj, tDelta in timeRef.items():
+            proj.setHours(tDelta, date)
+        return timeRef.keys()
+
+    def transaction(self, undoable=True):
+        return Transaction(self, undoable)
+
+    @synchronized
+    def applyEdits(self, edits):
+        days = {}
+        for edit in edits:
+            date = edit.time.date()
+            if date not in days:
+                days[date] = self.timeRecord.mutableDay(date)
+            if edit.newProject is None:
+                del days[date][edit.time]
+            else:
+                days[date][edit.time] = edit.newProject
+        return set(days.keys())
+
+    @synchronized
+    def commitEdits(self, edits, dates=None):
+        self.__log.info("Committing %d edits" % (len(edits)))
+        if dates is None:
+            dates = {edit.time.date() for edit in edits}
+        projects = set()
+        for date in sorted(dates):
+            self.timeRecord.touch(date)
+            projects.update(self.__updateProjectHours(
+                date, self.timeRecord[date]))
+            self.chargeIndex.updateDay(date, self.timeRecord[date])
+        today = dt.datetime.today().date()
+        if today in dates and len(self.timeRecord[today]) > 0:
+            self.prevTime = max(self.timeRecord[today].keys())
+        for edit in edits:
+            if edit.newProject is not None and edit.time > self.prevTime:
+                self.prevTime = edit.time
+        self.__updateLedger(dates)
+        for edit in edits:
+            if edit.newProject is not None and edit.oldProject is None:
+                self.events.publish(eventBus.PunchAdded(
+                    edit.time, edit.newProject))
+        self.events.publish(eventBus.DayRecomputed(
+            frozenset(dates), frozenset(projects)))
         self.flush()
 
+    def pushUndo(self, edits):
+        self.undoStack.append(edits)
+        self.redoStack = []
+
+    def clearUndo(self):
+        self.undoStack = []
+        self.redoStack = []
+
+    @synchronized
+    def undo(self):
+        if len(self.undoStack) == 0:
+            return False
+        self.__log.info("Undo")
+        edits = self.undoStack.pop()
+        inverse = [edit.inverse() for edit in reversed(edits)]
+        self.commitEdits(inverse, self.applyEdits(inverse))
+        self.redoStack.append(edits)
+        return True
+
+    @synchronized
+    def redo(self):
+        if len(self.redoStack) == 0:
+            return False
+        self.__log.info("Redo")
+        edits = self.redoStack.pop()
+        self.commitEdits(edits, self.applyEdits(edits))
+        self.undoStack.append(edits)
+        return True
+
     def addRecord(self, time, project):
         self.__log.info("Recording timestamp")
-        self.timeRecord[time.date()][time] = project
-
-        # Update project hours
-        timeRef = {}
-        startTime = sorted(self.timeRecord[time.date()].keys())[0]
-        for endTime in sorted(self.timeRecord[time.date()].keys())[1:]:
-            if self.timeRecord[time.date()][endTime] not in timeRef:
-                timeRef[self.timeRecord[time.date()][endTime]] = endTime - \
-                    startTime
-            else:
-                timeRef[self.timeRecord[time.date()][endTime]] += endTime - \
-                    startTime
-            startTime = endTime
-        for proj, tDelta in timeRef.items():
-            proj.setHours(tDelta, time.date())
-        if time > self.prevTime:
-            self.prevTime = time
-        for func in self.addHoursCallback:
-            func(project)
-        self.flush()
+        with self.transaction() as transaction:
+            transaction.insert(time, project)
 
+    @synchronized
     def recordHours(self, project):
         self.__log.info("Recording hours")
-        time = dt.datetime.now()
-        self.__today()[time] = project
-        project.addHours(time - self.prevTime, time.date())
+        # Stored as the instant and the day's hours recomputed from the
+        # stored instants, so neither depends on wall clock arithmetic
+        epoch, date, time = self.__now()
+        dayRecord = self.__today(date)
+        dayRecord.setEpoch(epoch, project)
+        self.timeRecord.touch(date)
+        self.__updateProjectHours(date, dayRecord)
         self.prevTime = time
-        for func in self.addHoursCallback:
-            func(project)
+        self.chargeIndex.updateDay(date, dayRecord)
+        self.__updateLedger([date])
+        self.pushUndo([Edit(time, None, project)])
+        self.events.publish(eventBus.PunchAdded(time, project))
         self.flush()
 
-    def getTodayTotalHours(self):
-        self.__log.info("Retrieving today's hours")
-        date = dt.datetime.now().date()
-        totalHours = 0
-        projectHours = self.getHours(date)
-        for chargeNumber, hours in projectHours.items():
-            totalHours += hours
-        return totalHours
-
-    def getTodayRemainingHours(self):
-        return self.dailyHours - self.getTodayTotalHours()
+    @synchronized
+    def getHoursMatrix(self, dates, projects=None):
+        if projects is None:
+            projects = self.projects
+        self.timeRecord.ensureLoaded(dates)
+        return hoursMatrix(dates, projects,
+                           {project: project.hours for project in projects})
+
+    def getFirstDate(self):
+        dates = list(dict.keys(self.timeRecord))
+        dates.extend(dt.date.fromisoformat(month + '-01')
+                     for month in self.timeRecord.unloadedMonths)
+        dates.extend(dt.date.fromisoformat(min(self.timeRecord.archive.summary(year)['days']))
+                     for year in self.timeRecord.archivedYears())
+        return min(dates, default=dt.datetime.today().date())
+
+    def __ledgerDates(self, dates):
+        # Billed hours are rounded per period, so whole periods are recomputed
+        return sorted({periodDate for date in dates
+                       for periodDate in self.billingRules.periodDates(date)
+                       if periodDate <= dt.datetime.today().date()})
+
+    @synchronized
+    def rebuildLedger(self, load=False):
+        # Without load only hours already in memory are counted, so opening
+        # does not read every month since the start.  The history merge
+        # rebuilds it with load once the rest is in.  Archived years that are
+        # not loaded count as their summary's total, so they are never read
+        self.ledgerComplete = False
+        self.ledgerSummaryYears = set()
+        if not self.ledger.enabled:
+            return
+        self.__log.info("Rebuilding flex balance")
+        today = dt.datetime.today().date()
+        self.ledger.rules = self.billingRules
+        start = self.billingRules.periodDates(self.ledger.start)[0]
+        summaryYears = {year for year in self.timeRecord.archivedYears()
+                        if year not in self.timeRecord.loadedYears and
+                        dt.date(year, 1, 1) >= start}
+        dates = [start + dt.timedelta(days=i) for i in range((today - start).days + 1)]
+        dates = [date for date in dates if date.year not in summaryYears]
+        if load:
+            self.timeRecord.ensureLoaded(dates)
+        self.ledgerComplete = self.timeRecord.isComplete() and all(
+            year in self.timeRecord.loadedYears or year in summaryYears
+            for year in self.timeRecord.archivedYears() if year >= start.year)
+        billable = [self.billingRules.isBillable(project) for project in self.projects]
+        hours = list(self.billingRules.apply(
+            hoursMatrix(dates, self.projects, {project: project.hours for project in self.projects}),
+            billable, dates).sum(axis=0)) if len(dates) > 0 else []
+        for date, yearHours in self.__archivedBillableHours(summaryYears):
+            dates.append(date)
+            hours.append(yearHours)
+        self.ledger.rebuild(dates, hours, today)
+        self.ledgerSummaryYears = summaryYears
+
+    def __archivedBillableHours(self, years):
+        # Each year's raw billable hours on its last recorded day, these are
+        # not rounded per period as the days themselves are
+        chargeNumbers = {project.chargeNumber for project in self.projects
+                         if self.billingRules.isBillable(project)}
+        for year in sorted(years):
+            summary = self.timeRecord.archive.summary(year)
+            if len(summary['days']) > 0:
+                yield dt.date.fromisoformat(max(summary['days'])), \
+                    sum(hours for chargeNumber, hours in summary['hours'].items()
+                        if chargeNumber in chargeNumbers)
+
+    def __updateLedger(self, dates):
+        if not self.ledger.enabled:
+            return
+        if any(date.year in self.ledgerSummaryYears for date in dates):
+            # The year now has its days loaded, which replace its summary
+            self.rebuildLedger()
+            return
+        dates = [date for date in self.__ledgerDates(dates) if date >= self.ledger.start]
+        if len(dates) == 0:
+            return
+        for date, hours in zip(dates, self.getBillableMatrix(dates).sum(axis=0)):
+            self.ledger.setWorked(date, float(hours))
 
-    def getEarliestReleaseTime(self):
-        if self.prevTime.date() != dt.datetime.now().date():
-            return dt.datetime.now() + \
-                dt.timedelta(hours=self.getTodayRemainingHours()) - \
-                dt.timedelta(minutes=7.5)
-        return self.prevTime + \
-            dt.timedelta(hours=self.getTodayRemainingHours()) - \
-            dt.timedelta(minutes=7.5)
+    def getFlexBalance(self, date=None):
+        # Through yesterday by default, today is still being worked
+        if date is None:
+            date = dt.datetime.today().date() - dt.timedelta(days=1)
+        return self.ledger.balance(date)
 
-    def getHours(self, date):
-        retval = {}
-        for project in self.projects:
-            retval[project.chargeNumber] = project.getBillableHours(date)
-        return retval
+    def getTodayRemainingHours(self):
+        if not self.ledger.enabled or not self.ledgerComplete:
+            return super().getTodayRemainingHours()
+        # Time banked before today shortens the day, a deficit lengthens it
+        today = dt.datetime.today().date()
+        return self.ledger.expectedHours(today) - self.getTodayTotalHours() - \
+            self.ledger.balance(today - dt.timedelta(days=1))
+
+    @synchronized
+    def findCharges(self, chargeNumber, start=None, end=None):
+        # History in the range is loaded first, after that this is a lookup
+        for month in sorted(self.timeRecord.unloadedMonths):
+            if (start is None or month >= records.monthKey(start)) and \
+                    (end is None or month <= records.monthKey(end)):
+                self.timeRecord.loadMonth(month)
+        for year in self.timeRecord.archivedYears():
+            if (start is None or year >= start.year) and \
+                    (end is None or year <= end.year):
+                self.timeRecord.loadYear(year)
+        return self.chargeIndex.query(chargeNumber, start, end)
+
+    def export(self, path, compact=False):
+        # May run on any thread, the lock is only held to take the snapshot.
+        # Days not in memory are read from disk without loading them, they
+        # are current there since a day is loaded before it is changed
+        self.__log.info("Exporting to %s" % (path))
+        with self.lock:
+            snapshot = TrackerSnapshot(self)
+            months = sorted(self.timeRecord.unloadedMonths)
+            years = [year for year in self.timeRecord.archivedYears()
+                     if year not in self.timeRecord.loadedYears]
+            recordHoursPath = self.recordHoursPath
+        projectMap = {project.chargeNumber: project for project in snapshot.projects}
+        days = dict(snapshot.days)
+        for month in months:
+            days.update(dataStore.loadShard(self.dataDir, month, projectMap)[0])
+        for year in years:
+            payload = self.timeRecord.archive.read(year)
+            days.update(dataStore.deserializeDays(payload['records'], projectMap,
+                                                  payload.get('zones')))
+        dataStore.exportV12(path, compact, dailyHours=snapshot.dailyHours,
+                            projects=snapshot.projects, days=days,
+                            recordHoursPath=recordHoursPath)
+
+    @synchronized
+    def snapshot(self, dates=()):
+        # Only dates already loaded, plus the ones given, are in the snapshot
+        self.timeRecord.ensureLoaded(dates)
+        return TrackerSnapshot(self)
 
 
 class HourTrackerViewer(tk.Frame):
@@ -275,7 +854,7 @@ class HourTrackerViewer(tk.Frame):
         super().__init__(master)
 
         self.__createWidget()
-        self.hourTracker.registerAddProjectCallback(self.updateProject)
+        self.hourTracker.subscribe(self.__onEvents, coalesce=self.after_idle)
 
     def __createWidget(self):
         if self.innerFrame is not None:
@@ -320,7 +899,7 @@ class HourTrackerViewer(tk.Frame):
             self.projectNameIdx = len(self.projectNames) - 1
         self.projectSelector.set(self.projectNames[self.projectNameIdx])
 
-    def updateProject(self, project):
+    def __onEvents(self, events):
         self.__createWidget()
 
     def update(self):
@@ -336,9 +915,6 @@ class HourTrackerViewer(tk.Frame):
                 'Entry Error', 'Error: Start time not found!')
             return
         self.projectSelector.set(self.projectNames[0])
-        self.innerFrame.destroy()
-        self.innerFrame = tk.Frame(self)
-        self.__createWidget()
 
     def setDate(self, *args):
         if self.recordFrame is not None:
@@ -366,30 +942,24 @@ class HourTrackerViewer(tk.Frame):
         d = TimeEditor(self, self.hourTracker.getProjectNames(includeArrival=True), title='Edit Time',
                        time=self._displayedProjects[event.widget][0], project=project)
         if d.result:
-            if d.result[1] != project and d.result[0] == timestamp:
-                #                 Just need to update the charge number
-                projectTree[timestamp] = d.result[1]
-            elif d.result[0] != timestamp and d.result[1] == project:
-                #                 Adjusting the time
-                projectTree.pop(timestamp, None)
-                projectTree[d.result[0]] = project
-            else:
-                #                 Adjusting time and charge number
-                projectTree.pop(timestamp, None)
-                projectTree[d.result[0]] = d.result[1]
-            self.update()
+            with self.hourTracker.transaction() as transaction:
+                if d.result[0] != timestamp:
+                    #                 Adjusting the time
+                    transaction.movePunch(timestamp, d.result[0])
+                if d.result[1] != project:
+                    #                 Updating the charge number
+                    transaction.changeChargeNumber(d.result[0], d.result[1])
 
 
 class ProjectList(tk.Frame):
     def __init__(self, master, hourTracker):
         super().__init__(master)
         self.hourTracker = hourTracker
-        self.hourTracker.registerAddHoursCallback(self.updateHours)
-
         self.innerFrame = None
         self.createWidget()
+        self.hourTracker.subscribe(self.__onEvents, coalesce=self.after_idle)
 
-    def updateHours(self, project):
+    def __onEvents(self, events):
         self.createWidget()
 
     def createWidget(self):
@@ -399,6 +969,7 @@ class ProjectList(tk.Frame):
 
         row = 0
         today = dt.datetime.today().date()
+        todayHours = self.hourTracker.getHours(today)
         for project in sorted(self.hourTracker.projects, key=operator.attrgetter('sortIdx')):
             if project.chargeNumber != "0":
                 tk.Label(self.innerFrame, text=project.name,
@@ -406,7 +977,7 @@ class ProjectList(tk.Frame):
                 tk.Label(self.innerFrame, text='%s' % (
                     project.chargeNumber), anchor=tk.NW).grid(row=row, column=1)
 
-                billableHours = project.getBillableHours(today)
+                billableHours = todayHours[project.chargeNumber]
                 if billableHours > 0:
                     tk.Label(self.innerFrame, text='%.2f hrs' % (
                         billableHours), anchor=tk.NW).grid(row=row, column=2)
@@ -433,6 +1004,12 @@ class ProjectList(tk.Frame):
         earliestReleaseTime = self.hourTracker.getEarliestReleaseTime()
         tk.Label(self.innerFrame, text="Earliest Off Time: %s" % (self.hourTracker.getEarliestReleaseTime(
         ).time().strftime('%H:%M')), anchor=tk.NW).grid(row=1, column=3)
+        if self.hourTracker.ledger.enabled:
+            if self.hourTracker.ledgerComplete:
+                flexText = "Flex Balance: %+.2f" % (self.hourTracker.getFlexBalance())
+            else:
+                flexText = "Flex Balance: loading"
+            tk.Label(self.innerFrame, text=flexText, anchor=tk.NW).grid(row=2, column=3)
 
         self.innerFrame.grid(row=0, column=0)
 
@@ -441,7 +1018,6 @@ class ProjectList(tk.Frame):
             Project(self.projectEntry.get(), self.chargeNumberEntry.get(), True))
         self.projectEntry.set("")
         self.chargeNumberEntry.set('')
-        self.createWidget()
 
 
 class SettingsDialog(tk.Toplevel):
@@ -455,6 +1031,27 @@ class SettingsDialog(tk.Toplevel):
         self.recordHoursPath = tk.StringVar()
         self.recordHoursPath.set(self.hour_tracker.recordHoursPath)
 
+        rules = self.hour_tracker.billingRules
+        self.roundingIncrement = tk.StringVar()
+        self.roundingIncrement.set('%g' % (rules.increment * 60))
+        self.roundingMode = tk.StringVar()
+        self.roundingMode.set(rules.rounding)
+        self.roundingScope = tk.StringVar()
+        self.roundingScope.set(rules.scope)
+        self.periodDays = tk.StringVar()
+        self.periodDays.set(str(rules.periodDays))
+        self.minimumCharge = tk.StringVar()
+        self.minimumCharge.set('%g' % (rules.minimumCharge))
+        self.nonBillable = tk.StringVar()
+        self.nonBillable.set(', '.join(sorted(rules.nonBillable)))
+        self.syncFolder = tk.StringVar()
+        self.syncFolder.set(self.hour_tracker.settings.get(
+            'sync', {}).get('folder', ''))
+        self.flexEnabled = tk.BooleanVar()
+        self.flexEnabled.set(self.hour_tracker.ledger.enabled)
+        self.flexStart = tk.StringVar()
+        self.flexStart.set(self.hour_tracker.ledger.start.isoformat())
+
         self.bodyFrame = None
         self.initial_focus = self.createBody()
 
@@ -485,6 +1082,40 @@ class SettingsDialog(tk.Toplevel):
         tk.Button(self.bodyFrame, text='...',
                   command=self.getRecordHoursPath).grid(row=0, column=2)
 
+        tk.Label(self.bodyFrame, text="Rounding Increment (min):").grid(
+            row=1, column=0)
+        tk.Entry(self.bodyFrame, textvariable=self.roundingIncrement).grid(
+            row=1, column=1)
+        tk.Label(self.bodyFrame, text="Rounding:").grid(row=2, column=0)
+        tk.OptionMenu(self.bodyFrame, self.roundingMode,
+                      *billingRules.BillingRules.ROUNDING_MODES).grid(row=2, column=1)
+        tk.Label(self.bodyFrame, text="Round Per:").grid(row=3, column=0)
+        tk.OptionMenu(self.bodyFrame, self.roundingScope,
+                      *billingRules.BillingRules.SCOPES).grid(row=3, column=1)
+        tk.Label(self.bodyFrame, text="Period Length (days):").grid(
+            row=4, column=0)
+        tk.Entry(self.bodyFrame, textvariable=self.periodDays).grid(
+            row=4, column=1)
+        tk.Label(self.bodyFrame, text="Minimum Charge (hrs):").grid(
+            row=5, column=0)
+        tk.Entry(self.bodyFrame, textvariable=self.minimumCharge).grid(
+            row=5, column=1)
+        tk.Label(self.bodyFrame, text="Non-billable Charge Numbers:").grid(
+            row=6, column=0)
+        tk.Entry(self.bodyFrame, textvariable=self.nonBillable).grid(
+            row=6, column=1)
+        tk.Label(self.bodyFrame, text="Sync Folder:").grid(row=7, column=0)
+        tk.Entry(self.bodyFrame, textvariable=self.syncFolder).grid(
+            row=7, column=1)
+        tk.Button(self.bodyFrame, text='...',
+                  command=self.getSyncFolder).grid(row=7, column=2)
+        tk.Label(self.bodyFrame, text="Flex Balance Start:").grid(
+            row=8, column=0)
+        tk.Entry(self.bodyFrame, textvariable=self.flexStart).grid(
+            row=8, column=1)
+        tk.Checkbutton(self.bodyFrame, text="Use for off time",
+                       variable=self.flexEnabled).grid(row=8, column=2)
+
         self.bodyFrame.grid(row=0, column=0)
 
     def getRecordHoursPath(self):
@@ -498,6 +1129,11 @@ class SettingsDialog(tk.Toplevel):
         newPath = tkf.askopenfilename(initialdir=init_path, parent=self)
         self.recordHoursPath.set(newPath)
 
+    def getSyncFolder(self):
+        newPath = tkf.askdirectory(parent=self)
+        if newPath:
+            self.syncFolder.set(newPath)
+
     def createAcceptFrame(self):
         if self.acceptFrame is not None:
             self.acceptFrame.destroy()
@@ -512,9 +1148,27 @@ class SettingsDialog(tk.Toplevel):
         self.parent.focus_set()
         self.destroy()
 
+    def getBillingRules(self):
+        nonBillable = [chargeNumber.strip() for chargeNumber
+                       in self.nonBillable.get().split(',') if chargeNumber.strip()]
+        return billingRules.BillingRules(
+            increment=float(self.roundingIncrement.get()) / 60.0,
+            rounding=self.roundingMode.get(),
+            scope=self.roundingScope.get(),
+            periodDays=int(self.periodDays.get()),
+            periodStart=self.hour_tracker.billingRules.periodStart,
+            minimumCharge=float(self.minimumCharge.get()),
+            nonBillable=nonBillable)
+
     def validate(self):
         try:
-            assert(os.path.isfile(self.recordHoursPath.get()))
+            assert(self.recordHoursPath.get() == "" or
+                   submission.isUrl(self.recordHoursPath.get()) or
+                   os.path.isfile(self.recordHoursPath.get()))
+            assert(self.syncFolder.get() == "" or
+                   os.path.isdir(self.syncFolder.get()))
+            self.getBillingRules()
+            dt.date.fromisoformat(self.flexStart.get())
             return True
         except:
             return False
@@ -527,6 +1181,13 @@ class SettingsDialog(tk.Toplevel):
 
         # apply changes
         self.hour_tracker.recordHoursPath = self.recordHoursPath.get()
+        self.hour_tracker.billingRules = self.getBillingRules()
+        self.hour_tracker.settings.setdefault(
+            'sync', {})['folder'] = self.syncFolder.get()
+        self.hour_tracker.ledger.enabled = self.flexEnabled.get()
+        self.hour_tracker.ledger.start = dt.date.fromisoformat(self.flexStart.get())
+        self.hour_tracker.notifySettingsChanged(
+            'recordHoursPath', 'billing', 'sync', 'flex')
 
         self.cancel()
 
@@ -652,9 +1313,285 @@ class TimeEditor(tk.Toplevel):
         self.result = date, self.projects[self.projectSelector.get()]
 
 
+class CalendarView(tk.Toplevel):
+    CELL = 16
+    LEFT = 70
+    TOP = 20
+    COLORS = ('#ebedf0', '#c6e48b', '#7bc96f', '#239a3b', '#196127')
+    ALL_PROJECTS = 'All'
+
+    def __init__(self, parent, hourTracker):
+        super().__init__(parent)
+        self.__log = logging.getLogger("chargeNumberTracker.CalendarView")
+        self.title('Calendar')
+        self.hourTracker = hourTracker
+        self.protocol("WM_DELETE_WINDOW", self.close)
+
+        today = dt.datetime.today().date()
+        first = hourTracker.getFirstDate()
+        start = first - dt.timedelta(days=first.weekday())
+        self.dates = [start + dt.timedelta(days=i)
+                      for i in range((today - start).days + 1)]
+        self.dateIdx = {date: idx for idx, date in enumerate(self.dates)}
+        self.projects = list(hourTracker.projects)
+        self.__reset()
+
+        self.mode = tk.StringVar(value='total')
+        self.projectSelector = tk.StringVar(value=self.ALL_PROJECTS)
+        controls = tk.Frame(self)
+        tk.Radiobutton(controls, text='Total', variable=self.mode, value='total',
+                       command=self.__refresh).grid(row=0, column=0)
+        tk.Radiobutton(controls, text='Billable', variable=self.mode,
+                       value='billable', command=self.__refresh).grid(row=0, column=1)
+        self.projectMenu = tk.OptionMenu(controls, self.projectSelector, self.ALL_PROJECTS)
+        self.projectMenu.grid(row=0, column=2)
+        self.__fillProjectMenu()
+        controls.grid(row=0, column=0, columnspan=2, sticky=tk.W)
+
+        self.canvas = tk.Canvas(self, width=self.LEFT + 7 * self.CELL + 10,
+                                height=min(40, len(self.dates) // 7 + 2) * self.CELL,
+                                background='white')
+        self.scrollbar = tk.Scrollbar(self, orient=tk.VERTICAL, command=self.canvas.yview)
+        self.canvas.configure(yscrollcommand=self.__onScroll)
+        self.canvas.grid(row=1, column=0, sticky=tk.NSEW)
+        self.scrollbar.grid(row=1, column=1, sticky=tk.NS)
+        self.canvas.bind('<Button-1>', self.__select)
+        self.canvas.bind('<MouseWheel>', lambda event: self.canvas.yview_scroll(
+            -1 if event.delta > 0 else 1, 'units'))
+        self.canvas.bind('<Button-4>', lambda event: self.canvas.yview_scroll(-1, 'units'))
+        self.canvas.bind('<Button-5>', lambda event: self.canvas.yview_scroll(1, 'units'))
+
+        self.details = tk.StringVar()
+        tk.Label(self, textvariable=self.details, anchor=tk.W, justify=tk.LEFT).grid(
+            row=2, column=0, columnspan=2, sticky=tk.EW)
+        self.rowconfigure(1, weight=1)
+
+        self.__draw()
+        self.canvas.yview_moveto(1.0)
+        self.__showVisible()
+        self.subscription = hourTracker.subscribe(self.__onEvents,
+                                                  coalesce=self.after_idle)
+
+    def __reset(self):
+        # hours and billed hold projects x days for the whole range, but only
+        # the computed columns are filled.  Columns are computed as they
+        # scroll into view, so archived years are only read when looked at
+        self.projects = list(self.hourTracker.projects)
+        self.hours = np.zeros((len(self.projects), len(self.dates)))
+        self.billed = np.zeros((len(self.projects), len(self.dates)))
+        self.computed = np.zeros(len(self.dates), dtype=bool)
+
+    def __expand(self, dates):
+        # Whole months, and whole billing periods since billing rounds over
+        # them, clipped to the calendar
+        rules = self.hourTracker.billingRules
+        idxs = set()
+        for month in {(date.year, date.month) for date in dates}:
+            date = max(dt.date(month[0], month[1], 1), self.dates[0])
+            while date.month == month[1] and date in self.dateIdx:
+                idxs.update(self.dateIdx[periodDate] for periodDate in rules.periodDates(date)
+                            if periodDate in self.dateIdx)
+                date += dt.timedelta(days=1)
+        return sorted(idxs)
+
+    def __compute(self, idxs):
+        rules = self.hourTracker.billingRules
+        billable = [rules.isBillable(project) for project in self.projects]
+        dates = [self.dates[idx] for idx in idxs]
+        self.hours[:, idxs] = self.hourTracker.getHoursMatrix(dates, self.projects)
+        self.billed[:, idxs] = rules.apply(self.hours[:, idxs], billable, dates)
+        self.computed[idxs] = True
+
+    def __visibleDates(self):
+        top = self.canvas.canvasy(0)
+        bottom = self.canvas.canvasy(max(self.canvas.winfo_height(),
+                                         int(self.canvas['height'])))
+        first = max(int((top - self.TOP) // self.CELL), 0) * 7
+        last = min(int((bottom - self.TOP) // self.CELL + 1) * 7, len(self.dates))
+        return self.dates[first:last]
+
+    def __showVisible(self):
+        idxs = [idx for idx in self.__expand(self.__visibleDates())
+                if not self.computed[idx]]
+        if len(idxs) > 0:
+            self.__log.debug("Computing %d days" % (len(idxs)))
+            self.__compute(idxs)
+            self.__refresh(idxs)
+
+    def __onScroll(self, first, last):
+        self.scrollbar.set(first, last)
+        self.after_idle(self.__showVisible)
+
+    def __fillProjectMenu(self):
+        menu = self.projectMenu['menu']
+        menu.delete(0, tk.END)
+        for name in [self.ALL_PROJECTS] + [
+                project.name for project in sorted(self.projects,
+                                                   key=operator.attrgetter('sortIdx'))
+                if project.chargeNumber != "0"]:
+            menu.add_command(label=name, command=lambda name=name: (
+                self.projectSelector.set(name), self.__refresh()))
+
+    def __matrix(self):
+        if self.mode.get() == 'billable':
+            return self.billed
+        return self.hours
+
+    def __aggregate(self):
+        name = self.projectSelector.get()
+        for row, project in enumerate(self.projects):
+            if project.name == name:
+                return self.__matrix()[row]
+        return self.__matrix().sum(axis=0)
+
+    def __cellColors(self, values):
+        scale = max(self.hourTracker.dailyHours, 1)
+        buckets = np.clip(np.ceil(values / scale * (len(self.COLORS) - 1)),
+                          0, len(self.COLORS) - 1).astype(int)
+        return [self.COLORS[bucket] for bucket in buckets]
+
+    def __draw(self):
+        self.canvas.delete('all')
+        for weekday, name in enumerate(['M', 'T', 'W', 'T', 'F', 'S', 'S']):
+            self.canvas.create_text(self.LEFT + (weekday + 0.5) * self.CELL,
+                                    self.TOP / 2, text=name)
+        self.cells = []
+        for idx, (date, color) in enumerate(zip(self.dates,
+                                                self.__cellColors(self.__aggregate()))):
+            x = self.LEFT + date.weekday() * self.CELL
+            y = self.TOP + idx // 7 * self.CELL
+            if date.day == 1 or idx == 0:
+                self.canvas.create_text(self.LEFT - 5, y + self.CELL / 2,
+                                        text=date.strftime('%b %Y'), anchor=tk.E)
+            self.cells.append(self.canvas.create_rectangle(
+                x + 1, y + 1, x + self.CELL - 1, y + self.CELL - 1,
+                fill=color, outline=''))
+        self.canvas.configure(scrollregion=self.canvas.bbox('all'))
+
+    def __refresh(self, idxs=None):
+        values = self.__aggregate()
+        if idxs is None:
+            idxs = range(len(self.dates))
+        colors = self.__cellColors(values[list(idxs)])
+        for idx, color in zip(idxs, colors):
+            self.canvas.itemconfigure(self.cells[idx], fill=color)
+
+    def __onEvents(self, events):
+        dates = set()
+        for event in events:
+            if isinstance(event, (eventBus.ProjectAdded, eventBus.SettingsChanged)):
+                self.__reset()
+                self.__fillProjectMenu()
+                self.__refresh()
+                self.__showVisible()
+                return
+            if isinstance(event, eventBus.PunchAdded):
+                dates.add(event.time.date())
+            elif isinstance(event, eventBus.DayRecomputed):
+                dates.update(event.dates)
+        # Billing rounds over whole periods, so a change moves its neighbours.
+        # Columns not computed yet are read when they come into view
+        idxs = sorted({self.dateIdx[periodDate] for date in dates
+                       for periodDate in self.hourTracker.billingRules.periodDates(date)
+                       if periodDate in self.dateIdx and self.computed[self.dateIdx[periodDate]]})
+        if len(idxs) > 0:
+            self.__compute(idxs)
+            self.__refresh(idxs)
+
+    def __select(self, event):
+        col = int((self.canvas.canvasx(event.x) - self.LEFT) // self.CELL)
+        row = int((self.canvas.canvasy(event.y) - self.TOP) // self.CELL)
+        idx = row * 7 + col
+        if col < 0 or col >= 7 or row < 0 or idx >= len(self.dates):
+            return
+        matrix = self.__matrix()
+        breakdown = ['%s (%s): %.2f' % (project.name, project.chargeNumber,
+                                        matrix[rowIdx, idx])
+                     for rowIdx, project in enumerate(self.projects)
+                     if matrix[rowIdx, idx] > 0]
+        self.details.set('%s: %.2f hrs\n%s' % (
+            self.dates[idx].strftime('%a %Y-%m-%d'), matrix[:, idx].sum(),
+            '\n'.join(breakdown)))
+
+    def close(self):
+        self.subscription.cancel()
+        self.destroy()
+
+
+class ChargeSearch(tk.Toplevel):
+    def __init__(self, parent, hourTracker):
+        super().__init__(parent)
+        self.__log = logging.getLogger("chargeNumberTracker.ChargeSearch")
+        self.title('Find Charge Number')
+        self.hourTracker = hourTracker
+
+        self.chargeNumber = tk.StringVar()
+        self.start = tk.StringVar()
+        self.end = tk.StringVar()
+        tk.Label(self, text="Charge Number:").grid(row=0, column=0)
+        entry = tk.Entry(self, textvariable=self.chargeNumber)
+        entry.grid(row=0, column=1)
+        entry.bind('<Return>', self.search)
+        entry.bind('<KP_Enter>', self.search)
+        tk.Label(self, text="From (YYYY-MM-DD):").grid(row=1, column=0)
+        tk.Entry(self, textvariable=self.start).grid(row=1, column=1)
+        tk.Label(self, text="To (YYYY-MM-DD):").grid(row=2, column=0)
+        tk.Entry(self, textvariable=self.end).grid(row=2, column=1)
+        tk.Button(self, text='Search', command=self.search).grid(row=0, column=2)
+
+        self.results = tk.Listbox(self, width=60, height=20)
+        scrollbar = tk.Scrollbar(self, orient=tk.VERTICAL, command=self.results.yview)
+        self.results.configure(yscrollcommand=scrollbar.set)
+        self.results.grid(row=3, column=0, columnspan=3, sticky=tk.NSEW)
+        scrollbar.grid(row=3, column=3, sticky=tk.NS)
+        self.total = tk.StringVar()
+        tk.Label(self, textvariable=self.total, anchor=tk.W).grid(
+            row=4, column=0, columnspan=3, sticky=tk.EW)
+        self.rowconfigure(3, weight=1)
+        entry.focus_set()
+
+    def __date(self, var):
+        if var.get().strip() == '':
+            return None
+        return dt.date.fromisoformat(var.get().strip())
+
+    def search(self, *args):
+        try:
+            start = self.__date(self.start)
+            end = self.__date(self.end)
+        except ValueError:
+            tkMessageBox.showerror('Entry Error', 'Error: Dates must be YYYY-MM-DD',
+                                   parent=self)
+            return
+        chargeNumber = self.chargeNumber.get().strip()
+        self.__log.info("Searching %s" % (chargeNumber))
+        charges = self.hourTracker.findCharges(chargeNumber, start, end)
+        self.results.delete(0, tk.END)
+        for charge in charges:
+            self.results.insert(tk.END, '%s  %5.2f hrs  %s' % (
+                charge.date.strftime('%a %Y-%m-%d'), charge.hours,
+                ', '.join('%s-%s' % (begin.strftime('%H:%M'), finish.strftime('%H:%M'))
+                          for begin, finish in charge.intervals)))
+        self.total.set('%d days, %.2f hrs' % (
+            len(charges), sum(charge.hours for charge in charges)))
+
+
 class ChargeNumberTrackerApp:
-    def __init__(self):
+    HISTORY_POLL_MS = 50
+
+    def __init__(self, logDir='.', profileDuration=None):
         self.__log = logging.getLogger("chargeNumberTracker.App")
+        self.debug = test or os.environ.get('CHARGE_NUMBER_DEBUG', '') != ''
+        self.profiler = profiling.Profiler(logDir, [
+            (HourTracker, 'open'),
+            (HourTracker, 'openCurrent'),
+            (HourTracker, 'mergeHistory'),
+            (HourTracker, 'flush'),
+            (HourTracker, 'addRecord'),
+            (HourTrackerViewer, '_HourTrackerViewer__createWidget'),
+            (ProjectList, 'createWidget')])
+        if profileDuration is not None:
+            self.profiler.start(profileDuration)
         self.platform = platform.system()
         if test:
             self.dataPath = os.path.join('.', 'chargeNumber')
@@ -678,19 +1615,22 @@ class ChargeNumberTrackerApp:
             os.mkdir(self.dataPath)
 
         self.tracker = HourTracker(self.dataPath)
+        self.submitter = None
 
         try:
-            self.tracker.open()
+            self.tracker.openCurrent()
         except Exception as e:
             print(traceback.print_last())
             self.__log.info("Failed to load data")
             if tkMessageBox.askyesno("Charge Number Hour Tracker", "Failed to "
-                                     "load data - would you like to delete the old data?"):
+                                     "load data - would you like to set the old data aside "
+                                     "and start clean?"):
                 try:
-                    self.__log.info("Deleting old data")
-                    os.remove(self.tracker.path)
+                    self.__log.info("Setting old data aside")
+                    aside = dataStore.setAside(self.tracker.dataDir)
+                    self.__log.warning("Old data moved to %s" % (aside))
                     self.__log.info("Opening clean")
-                    self.tracker.open()
+                    self.tracker.openCurrent()
                 except:
                     tkMessageBox.askokcancel(
                         "Charge Number Hour Tracker", "Fatal Error - Exiting")
@@ -699,9 +1639,13 @@ class ChargeNumberTrackerApp:
                 self.__log.info("User declined to clean bad data")
                 return
 
+        logConfig.applySettings(self.tracker.settings.setdefault(
+            'logging', logConfig.DEFAULT_SETTINGS.copy()))
+
         self.__log.debug("Creating GUI")
         self.master = tk.Tk()
         self.master.protocol("WM_DELETE_WINDOW", self.destroy)
+        self.profiler.setScheduler(self.master.after)
 
         self.master.title('Charge Number Hour Tracker')
         self.menubar = None
@@ -718,10 +1662,51 @@ class ChargeNumberTrackerApp:
 
         self.__log.debug("Assigning global hotkey")
         self.master.bind('<Control-Shift-S>', self.arrive)
+        self.master.bind('<Control-z>', self.undo)
+        self.master.bind('<Control-y>', self.redo)
+
+        self.historyFrame = None
+        self.tracker.startHistoryLoad()
+        if not self.tracker.isHistoryLoaded():
+            self.historyFrame = tk.Frame(self.master)
+            tk.Label(self.historyFrame, text='Loading history').grid(
+                row=0, column=0)
+            self.historyProgress = ttk.Progressbar(
+                self.historyFrame, mode='determinate',
+                maximum=self.tracker.getHistoryProgress()[1])
+            self.historyProgress.grid(row=0, column=1, sticky=tk.EW)
+            self.historyFrame.columnconfigure(1, weight=1)
+            self.historyFrame.grid(row=1, column=0, columnspan=2, sticky=tk.EW)
+            self.master.after(self.HISTORY_POLL_MS, self.__pollHistory)
 
         self.__log.debug("Starting main loop")
         self.master.mainloop()
 
+    def __pollHistory(self):
+        try:
+            done = self.tracker.mergeHistory()
+        except Exception as e:
+            # Polling stops here, what was merged so far stays usable
+            self.__log.exception("History merge failed")
+            self.historyFrame.destroy()
+            self.historyFrame = None
+            tkMessageBox.showerror("Charge Number Hour Tracker",
+                                   "Loading history stopped: %s" % (e))
+            return
+        self.historyProgress['value'] = self.tracker.getHistoryProgress()[0]
+        if not done:
+            self.master.after(self.HISTORY_POLL_MS, self.__pollHistory)
+            return
+        self.__log.info("History loaded")
+        self.historyFrame.destroy()
+        self.historyFrame = None
+        if len(self.tracker.historyErrors) > 0:
+            tkMessageBox.showerror(
+                "Charge Number Hour Tracker",
+                "These months could not be read and are left as they are on disk:\n%s" % (
+                    "\n".join("%s: %s" % (month, error)
+                              for month, error in self.tracker.historyErrors)))
+
     def createMenu(self):
         self.__log.info("Creating menu")
         if self.menubar:
@@ -731,37 +1716,161 @@ class ChargeNumberTrackerApp:
         filemenu = tk.Menu(self.menubar, tearoff=0)
         filemenu.add_command(label='Arrive', command=self.arrive)
         filemenu.add_command(label='Get Hours', command=self.getHours)
+        filemenu.add_command(label='Calendar...', command=self.showCalendar)
+        filemenu.add_command(label='Find Charge Number...',
+                             command=self.findCharges)
+        filemenu.add_command(label='Export...', command=self.export)
         filemenu.add_command(label='Record Custom...',
                              command=self.recordCustom)
         filemenu.add_separator()
         filemenu.add_command(label='Preferences', command=self.setPrefs)
         filemenu.add_separator()
+        filemenu.add_command(label='Sync Now', command=self.sync,
+                             state=("disabled" if self.tracker.settings.get(
+                                 'sync', {}).get('folder', '') == "" else "normal"))
         filemenu.add_command(label='Log Hours', command=self.logHours,
                              state=("disabled" if self.tracker.recordHoursPath is "" else "normal"))
+        if self.debug:
+            filemenu.add_command(label='Capture Profile',
+                                 command=self.captureProfile)
         filemenu.add_separator()
         filemenu.add_command(label='Exit', command=self.destroy)
         self.menubar.add_cascade(label="File", menu=filemenu)
+        editmenu = tk.Menu(self.menubar, tearoff=0)
+        editmenu.add_command(label='Undo', command=self.undo,
+                             accelerator='Ctrl+Z')
+        editmenu.add_command(label='Redo', command=self.redo,
+                             accelerator='Ctrl+Y')
+        self.menubar.add_cascade(label="Edit", menu=editmenu)
         self.master.config(menu=self.menubar)
 
     def logHours(self):
         self.__log.info("Logging Hours")
         excPath = self.tracker.recordHoursPath
-        if excPath is not "":
-            if platform.system() == 'Linux':
-                subprocess.Popen(shlex.split(excPath))
-            elif platform.system() == 'Windows':
-                subprocess.Popen(shlex.split(excPath, posix=False), shell=True)
+        if excPath == "":
+            return
+        if self.submitter is None:
+            if submission.isUrl(excPath):
+                self.submitter = submission.HttpSubmitter.fromSettings(
+                    excPath, self.tracker.settings.get('submission', {}))
+            else:
+                self.submitter = submission.LauncherSubmitter(excPath)
+        today = dt.datetime.today().date()
+        dates = [date for date in self.tracker.billingRules.periodDates(today)
+                 if date <= today]
+        self.submitter.submit(submission.timesheetEntries(
+            self.tracker.snapshot(dates), dates))
+        if isinstance(self.submitter, submission.HttpSubmitter):
+            self.master.after(500, self.__pollSubmission, self.submitter)
+
+    def __pollSubmission(self, submitter):
+        # Polls the submitter that was used even if setPrefs has replaced
+        # it since, its unsent batches are still reported.  Completion is
+        # read first so a result posted while draining is not missed
+        done = submitter.batches.unfinished_tasks == 0
+        failed = []
+        while not submitter.results.empty():
+            batch, error = submitter.results.get_nowait()
+            if error is not None:
+                failed.append(error)
+        if len(failed) > 0:
+            tkMessageBox.showerror("Charge Number Hour Tracker",
+                                   "Failed to log hours: %s" % (failed[-1]))
+        if not done:
+            self.master.after(500, self.__pollSubmission, submitter)
+
+    def sync(self):
+        self.__log.info("Syncing")
+        try:
+            result = self.tracker.sync()
+        except OSError as e:
+            tkMessageBox.showerror("Charge Number Hour Tracker",
+                                   "Sync failed: %s" % (e))
+            return
+        if result is not None and len(result.conflicts) > 0:
+            tkMessageBox.showwarning("Charge Number Hour Tracker",
+                                     "Sync resolved %d conflicting punches:\n%s" % (
+                                         len(result.conflicts),
+                                         '\n'.join('%s: %s / %s -> %s' % (
+                                             conflict.time.strftime('%Y-%m-%d %H:%M'),
+                                             conflict.localChargeNumber,
+                                             conflict.peerChargeNumber,
+                                             conflict.chargeNumber)
+                                             for conflict in result.conflicts[:10])))
 
     def arrive(self, *args):
         self.__log.info("Recording arrive")
         self.tracker.recordArrive()
-        self.htViewer.update()
+
+    def __typing(self, event):
+        # Entries keep the keys for their own editing
+        return event is not None and isinstance(event.widget, (tk.Entry, ttk.Entry, tk.Spinbox))
+
+    def undo(self, event=None):
+        if self.__typing(event):
+            return
+        self.__log.info("Undo")
+        self.tracker.undo()
+
+    def redo(self, event=None):
+        if self.__typing(event):
+            return
+        self.__log.info("Redo")
+        self.tracker.redo()
+
+    def captureProfile(self):
+        self.__log.info("Capturing profile")
+        self.profiler.start()
 
     def destroy(self):
         self.__log.info("Exiting")
+        self.profiler.stop()
+        if self.submitter is not None:
+            self.submitter.close()
         self.tracker.close()
         self.master.destroy()
 
+    def export(self):
+        self.__log.info("Exporting")
+        path = tkf.asksaveasfilename(parent=self.master, defaultextension='.json',
+                                     filetypes=[('JSON', '*.json')])
+        if not path:
+            return
+        # Written from a snapshot on its own thread, punching carries on
+        results = queue.Queue()
+        threading.Thread(target=self.__runExport, args=(path, results),
+                         daemon=True, name="Export").start()
+        self.master.after(200, self.__pollExport, path, results)
+
+    def __runExport(self, path, results):
+        try:
+            self.tracker.export(path)
+            results.put(None)
+        except Exception as e:
+            self.__log.exception("Export failed")
+            results.put(e)
+
+    def __pollExport(self, path, results):
+        try:
+            error = results.get_nowait()
+        except queue.Empty:
+            self.master.after(200, self.__pollExport, path, results)
+            return
+        if error is not None:
+            tkMessageBox.showerror("Charge Number Hour Tracker",
+                                   "Export failed: %s" % (error))
+        else:
+            tkMessageBox.showinfo("Charge Number Hour Tracker",
+                                  "Exported to %s" % (path))
+
+    def findCharges(self):
+        self.__log.info("Opening charge number search")
+        ChargeSearch(self.master, self.tracker)
+
+    def showCalendar(self):
+        self.__log.info("Opening calendar")
+        CalendarView(self.master, self.tracker)
+
     def getHours(self):
         self.__log.info("Retrieving hours")
         print(self.tracker.getHours(dt.datetime.today().date()))
@@ -778,26 +1887,27 @@ class ChargeNumberTrackerApp:
             else:
                 self.__log.info("Custom project")
                 self.tracker.addRecord(*d.result)
-            self.htViewer.update()
 
     def setPrefs(self):
         self.__log.info("Opening settings")
         d = SettingsDialog(self.master, self.tracker)
+        if self.submitter is not None:
+            self.submitter.close()
+            self.submitter = None
         self.createMenu()
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Charge Number Hour Tracker')
+    parser.add_argument('--profile', nargs='?', type=float, default=None,
+                        const=profiling.DEFAULT_DURATION, metavar='SECONDS',
+                        help='Profile startup and UI actions for SECONDS')
+    args = parser.parse_args()
+    profileDuration = args.profile
+    if profileDuration is None:
+        profileDuration = profiling.durationFromEnvironment()
+
     logName = 'log.log'
-    logger = logging.getLogger()
-    logger.setLevel(logging.DEBUG)
-    consoleOutput = logging.StreamHandler(sys.stdout)
-    consoleOutput.setLevel(logging.WARNING)
-    formatter = logging.Formatter(
-        '%(asctime)s.%(msecs)03d: %(levelname)s:%(name)s: %(message)s', datefmt='%Y-%M-%d %H:%m:%S')
-    consoleOutput.setFormatter(formatter)
-    logger.addHandler(consoleOutput)
-    fileOutput = logging.FileHandler(logName)
-    fileOutput.setLevel(logging.INFO)
-    fileOutput.setFormatter(formatter)
-    logger.addHandler(fileOutput)
-    root = ChargeNumberTrackerApp()
+    logConfig.startLogging(logName)
+    root = ChargeNumberTrackerApp(os.path.dirname(os.path.abspath(logName)),
+                                  profileDuration)
@@ -1,6 +1,12 @@
 from abc import ABC, abstractmethod
 from chargeNumberTracker import Project
+from records import DayRecord, internDate, dayHours, monthKey
 import datetime as dt
+import os
+import json
+import glob
+import logging
+import zlib
 
 def fromDict(serialData):
 	readerMap = {}
@@ -21,18 +27,327 @@ def toDict(**kwargs):
 		maxVer = max(subclass.version(), maxVer)
 	return readerMap[maxVer].toDict(**kwargs)
 
+def serializeDays(days):
+	records = {}
+	for date, dayRecord in days.items():
+		records[date.isoformat()] = {}
+		if isinstance(dayRecord, DayRecord):
+			for epoch, project in dayRecord.epochItems():
+				records[date.isoformat()][epoch / 1000000] = project.chargeNumber
+		else:
+			for time, project in dayRecord.items():
+				records[date.isoformat()][dt.datetime.timestamp(time)] = project.chargeNumber
+	return records
+
+def recomputeHours(timeRecord):
+	# Sets every project's hours from each day's own punches and returns the
+	# last punch.  The 1.2 and older readers carried the previous punch across days
+	prevTime = dt.datetime.fromtimestamp(0)
+	for date, dayRecord in sorted(timeRecord.items()):
+		for project, hours in dayHours(dayRecord).items():
+			project.setHours(hours, date)
+		if len(dayRecord) > 0:
+			prevTime = max(prevTime, max(dayRecord.keys()))
+	return prevTime
+
+def serializeZones(days):
+	return {date.isoformat(): dayRecord.zone for date, dayRecord in days.items()
+			if isinstance(dayRecord, DayRecord) and dayRecord.zone is not None}
+
+def serializeArchive(days):
+	return {'records': serializeDays(days), 'zones': serializeZones(days)}
+
+def deserializeDays(records, projectMap, zones=None):
+	# Times are UTC epoch seconds, zones maps a date to the zone its punches
+	# were recorded in, days without one use the platform's zone
+	if zones is None:
+		zones = {}
+	days = {}
+	for dateStr, dayRecords in sorted(records.items()):
+		date = internDate(dt.date.fromisoformat(dateStr))
+		days[date] = DayRecord.fromEpochs(((int(round(float(time) * 1000000)), projectMap[str(chargeNumber)])
+			for time, chargeNumber in dayRecords.items()), zones.get(dateStr))
+	return days
+
+def shardPath(dataDir, month):
+	return os.path.join(dataDir, 'records', '%s.json' % (month))
+
+def listBackups(path):
+	existingBackupNums = []
+	for backup in glob.glob("%s.*" % (path)):
+		suffix = backup[len(path) + 1:]
+		if suffix.isdigit():
+			existingBackupNums.append((backup, int(suffix)))
+	return existingBackupNums
+
+def rotateBackups(path, backups):
+	existingBackupNums = listBackups(path)
+	for backup, number in sorted(existingBackupNums, reverse=True, key=lambda x: x[1]):
+		if number + 1 >= backups:
+			os.remove(backup)
+		else:
+			os.rename(backup, "%s.%d" % (path, number + 1))
+	if os.path.isfile(path):
+		os.rename(path, "%s.%d" % (path, 0))
+
+def writeAtomic(path, backups, write):
+	# The new file is complete on disk before it replaces the old one, which
+	# becomes backup 0.  A crash leaves at worst the file missing, readJson
+	# then falls back to the backup
+	if not os.path.isdir(os.path.dirname(path)):
+		os.makedirs(os.path.dirname(path))
+	with open(path + '.tmp', 'w') as file:
+		write(file)
+		file.flush()
+		os.fsync(file.fileno())
+	rotateBackups(path, backups)
+	os.replace(path + '.tmp', path)
+
+def readJson(path):
+	# The newest of path and its backups that parses
+	candidates = [path] + [backup for backup, _ in sorted(listBackups(path), key=lambda x: x[1])]
+	error = None
+	for candidate in candidates:
+		try:
+			with open(candidate, 'r') as file:
+				data = json.load(file)
+		except (OSError, ValueError) as e:
+			error = e
+			continue
+		if candidate != path:
+			logging.getLogger("chargeNumberTracker.dataStore").warning(
+				"%s is unreadable (%s), using %s" % (path, error, candidate))
+		return data
+	raise error
+
+def writeJson(path, data, backups):
+	writeAtomic(path, backups, lambda file: json.dump(data, file, indent=4, sort_keys=True))
+
+def jsonLayout(compact, level):
+	# Separators and newline matching json.dump with indent=4, or the
+	# default compact separators
+	if compact:
+		return ',', ':', ''
+	return ',', ': ', '\n' + ' ' * (4 * level)
+
+def nestedJson(obj, compact, level):
+	if compact:
+		return json.dumps(obj, sort_keys=True, separators=(',', ':'))
+	return json.dumps(obj, indent=4, sort_keys=True).replace('\n', '\n' + ' ' * (4 * level))
+
+def streamDays(file, days, compact=False, level=0):
+	# Writes json.dump(serializeDays(days), sort_keys=True) one day at a
+	# time, days and punches are already in sorted order
+	sep, colon, newline = jsonLayout(compact, level)
+	_, _, innerNewline = jsonLayout(compact, level + 1)
+	_, _, punchNewline = jsonLayout(compact, level + 2)
+	file.write('{')
+	for idx, date in enumerate(sorted(days)):
+		dayRecord = days[date]
+		if not isinstance(dayRecord, DayRecord):
+			dayRecord = DayRecord(dayRecord)
+		punches = sep.join('%s"%r"%s%s' % (punchNewline, epoch / 1000000, colon,
+				json.dumps(project.chargeNumber)) for epoch, project in dayRecord.epochItems())
+		file.write('%s%s"%s"%s{%s%s}' % (sep if idx > 0 else '', innerNewline,
+				date.isoformat(), colon, punches, innerNewline if len(dayRecord) > 0 else ''))
+	if len(days) > 0:
+		file.write(newline)
+	file.write('}')
+
+def streamObject(file, fields, compact=False):
+	# fields maps each top level key to either a JSON value or a function
+	# writing the value to file at nesting level 1
+	sep, colon, newline = jsonLayout(compact, 0)
+	_, _, innerNewline = jsonLayout(compact, 1)
+	file.write('{')
+	for idx, key in enumerate(sorted(fields)):
+		file.write('%s%s%s%s' % (sep if idx > 0 else '', innerNewline, json.dumps(key), colon))
+		if callable(fields[key]):
+			fields[key](file)
+		else:
+			file.write(nestedJson(fields[key], compact, 1))
+	if len(fields) > 0:
+		file.write(newline)
+	file.write('}')
+
+class Crc32Sink():
+	# Write-only file that keeps the CRC-32 of the text written to it
+	def __init__(self):
+		self.value = 0
+
+	def write(self, text):
+		self.value = zlib.crc32(text.encode('utf-8'), self.value)
+
+def totalsChecksum(value, zones, hours):
+	for obj in (zones, hours):
+		value = zlib.crc32(json.dumps(obj, sort_keys=True, separators=(',', ':')).encode('utf-8'), value)
+	return '%08x' % (value)
+
+def shardChecksum(shard):
+	# Over the compact JSON of the records as read back, then the zones and
+	# totals, so one C-level pass validates the whole month
+	value = zlib.crc32(json.dumps(shard['records'], separators=(',', ':')).encode('utf-8'))
+	return totalsChecksum(value, shard.get('zones', {}), shard['hours'])
+
+def writeShard(path, shard, backups, compact=False):
+	if not os.path.isdir(os.path.dirname(path)):
+		os.makedirs(os.path.dirname(path))
+	zones = serializeZones(shard['days'])
+	sink = Crc32Sink()
+	streamDays(sink, shard['days'], True)
+	writeAtomic(path, backups, lambda file: streamObject(file, {'month': shard['month'],
+			'version': shard['version'],
+			'hours': shard['hours'],
+			'zones': zones,
+			'checksum': totalsChecksum(sink.value, zones, shard['hours']),
+			'records': lambda file: streamDays(file, shard['days'], compact, 1)}, compact))
+
+def exportV12(path, compact=False, **kwargs):
+	# A complete single file in the 1.2 layout, days is every day to export
+	projects = {project.chargeNumber: {'name': project.name,
+			'billable': project.isBillable, 'sort': project.sortIdx}
+			for project in kwargs['projects']}
+	with open(path + '.tmp', 'w') as file:
+		streamObject(file, {'version': 1.2,
+				'dailyHours': kwargs['dailyHours'],
+				'projects': projects,
+				'recordHoursPath': kwargs['recordHoursPath'],
+				'records': lambda file: streamDays(file, kwargs['days'], compact, 1)}, compact)
+	os.replace(path + '.tmp', path)
+
+def decodeShard(shard, projectMap):
+	# Pure decoding, safe to run off the main thread.  Hours are returned as
+	# (project, hours, date) rather than applied to the projects
+	days = deserializeDays(shard['records'], projectMap, shard.get('zones'))
+	hours = []
+	# Totals that fail their checksum are recomputed from the punches
+	if shard.get('checksum') == shardChecksum(shard) and \
+			all(chargeNumber in projectMap for totals in shard['hours'].values()
+				for chargeNumber in totals):
+		for dateStr, totals in shard['hours'].items():
+			date = internDate(dt.date.fromisoformat(dateStr))
+			for chargeNumber, projectHours in totals.items():
+				hours.append((projectMap[chargeNumber], float(projectHours), date))
+		return days, hours
+	for date, dayRecord in days.items():
+		for project, projectHours in dayHours(dayRecord).items():
+			hours.append((project, projectHours, date))
+	return days, hours
+
+def loadShard(dataDir, month, projectMap):
+	shard = readJson(shardPath(dataDir, month))
+	assert(month == shard['month'])
+	return decodeShard(shard, projectMap)
+
+def load(dataDir, months=None):
+	# months limits which record shards are read, the rest are reported in
+	# 'unloadedMonths'
+	path = os.path.join(dataDir, 'data.json')
+	if os.path.isfile(path) or len(listBackups(path)) > 0:
+		serialData = readJson(path)
+	else:
+		serialData = {}
+	version = float(serialData.get('version', 0))
+	if version >= 2.2:
+		serialData['shards'] = {}
+		if months is not None:
+			# The newest shard holds the last punch
+			months = set(months) | set(serialData.get('months', [])[-1:])
+		for month in serialData.get('months', []):
+			if months is not None and month not in months:
+				continue
+			serialData['shards'][month] = readJson(shardPath(dataDir, month))
+	data = fromDict(serialData)
+	data['version'] = version
+	data.setdefault('unloadedMonths', [])
+	return data
+
+def setAside(dataDir):
+	# Moves the manifest, record shards and archive with their backups to a
+	# dated folder, so a clean start neither mixes with nor loses them
+	aside = os.path.join(dataDir, 'unreadable-%s' % (dt.datetime.now().strftime('%Y%m%d-%H%M%S')))
+	os.makedirs(aside)
+	for path in glob.glob(os.path.join(dataDir, 'data.json*')) + \
+			[os.path.join(dataDir, 'records'), os.path.join(dataDir, 'archive')]:
+		if os.path.exists(path):
+			os.replace(path, os.path.join(aside, os.path.basename(path)))
+	return aside
+
+def save(dataDir, backups, **kwargs):
+	# Only the months in kwargs['months'] are rewritten, the manifest always is
+	data = toDict(**kwargs)
+	for month, shard in data.pop('shards').items():
+		writeShard(shardPath(dataDir, month), shard, backups, kwargs.get('compact', False))
+	writeJson(os.path.join(dataDir, 'data.json'), data, backups)
+	for month in kwargs.get('removedMonths', ()):
+		if month not in data['months'] and os.path.isfile(shardPath(dataDir, month)):
+			rotateBackups(shardPath(dataDir, month), backups)
+
+
+def readManifest(serialData):
+	assert('months' in serialData)
+	assert('shards' in serialData)
+	assert('projects' in serialData)
+	assert('dailyHours' in serialData)
+	data = {}
+	data['dailyHours'] = 8.0
+	data['projects'] = {}
+	data['projects']['0'] = {'billable': False, 'name': 'Arrive', 'sort': 0}
+	data['projects']['1'] = {'billable': False, 'name': 'Break', 'sort': 1}
+	data['recordHoursPath'] = ''
+	data['settings'] = {}
+	data.update(serialData)
+
+	dailyHours = float(data['dailyHours'])
+	projects = []
+	projectMap = {}
+	for chargeNumberStr, localAttr in sorted(data['projects'].items()):
+		chargeNumber = (chargeNumberStr)
+		projectAttr = defaultProj.copy()
+		projectAttr.update(localAttr)
+		project = Project(projectAttr['name'], chargeNumber, projectAttr['billable'], sortIdx = projectAttr['sort'])
+		projects.append(project)
+		if chargeNumber == "0":
+			arriveProject = project
+		projectMap[chargeNumber] = project
+
+	timeRecord = {}
+	prevTime = dt.datetime.fromtimestamp(0)
+	for month, shard in sorted(data['shards'].items()):
+		assert(month == shard['month'])
+		days, hours = decodeShard(shard, projectMap)
+		for project, projectHours, date in hours:
+			project.setHours(projectHours, date)
+		for date, dayRecord in days.items():
+			timeRecord[date] = dayRecord
+			if len(dayRecord) > 0:
+				prevTime = max(prevTime, dayRecord.lastTime())
+	unloadedMonths = [month for month in data['months'] if month not in data['shards']]
+	recordHoursPath = data['recordHoursPath']
+	return {'dailyHours':dailyHours, 
+			'projects':projects, 
+			'timeRecord':timeRecord, 
+			'prevTime':prevTime, 
+			'arriveProject':arriveProject,
+			'recordHoursPath':recordHoursPath,
+			'settings':data['settings'],
+			'unloadedMonths':unloadedMonths}
+
 
 outDictKeys = ['dailyHours', 
 				'projects', 
 				'timeRecord', 
 				'prevTime', 
 				'arriveProject', 
-				'recordHoursPath']
+				'recordHoursPath',
+				'settings',
+				'unloadedMonths']
 
 inDictKeys = ['dailyHours', 
 				'projects', 
 				'timeRecord', 
-				'recordHoursPath']
+				'recordHoursPath',
+				'settings']
 
 defaultProj = {'billable': True, 'sort': 0}
 
@@ -81,18 +396,12 @@ class v0_0(BaseVersion):
 			projectMap[chargeNumber] = project
 		
 		timeRecord = {}
-		prevTime = dt.datetime.fromtimestamp(0)
 		for dateStr, records in sorted(data['records'].items()):
 			date = dt.datetime.strptime(dateStr, '%Y-%m-%d').date()
 			timeRecord[date] = {}
 			for time, chargeNumber in sorted(records.items()):
-				project = projectMap[str(chargeNumber)]
-				dtTime = dt.datetime.fromtimestamp(float(time))
-				timeRecord[date][dtTime] = project
-				if chargeNumber != '0':
-					project.addHours(dtTime - prevTime, date)
-				prevTime = dtTime
-				prevTime = max(prevTime, prevTime)
+				timeRecord[date][dt.datetime.fromtimestamp(float(time))] = projectMap[str(chargeNumber)]
+		prevTime = recomputeHours(timeRecord)
 		return {"dailyHours":dailyHours, 
 				"projects":projects, 
 				"timeRecord":timeRecord, 
@@ -142,18 +451,12 @@ class v1_0(BaseVersion):
 			projectMap[chargeNumber] = project
 		
 		timeRecord = {}
-		prevTime = dt.datetime.fromtimestamp(0)
 		for dateStr, records in sorted(data['records'].items()):
 			date = dt.datetime.strptime(dateStr, '%Y-%m-%d').date()
 			timeRecord[date] = {}
 			for time, chargeNumber in sorted(records.items()):
-				project = projectMap[str(chargeNumber)]
-				dtTime = dt.datetime.fromtimestamp(float(time))
-				timeRecord[date][dtTime] = project
-				if chargeNumber != '0':
-					project.addHours(dtTime - prevTime, date)
-				prevTime = dtTime
-				prevTime = max(prevTime, prevTime)
+				timeRecord[date][dt.datetime.fromtimestamp(float(time))] = projectMap[str(chargeNumber)]
+		prevTime = recomputeHours(timeRecord)
 		return {"dailyHours":dailyHours, 
 				"projects":projects, 
 				"timeRecord":timeRecord, 
@@ -203,18 +506,12 @@ class v1_1(BaseVersion):
 			projectMap[chargeNumber] = project
 		
 		timeRecord = {}
-		prevTime = dt.datetime.fromtimestamp(0)
 		for dateStr, records in sorted(data['records'].items()):
 			date = dt.datetime.strptime(dateStr, '%Y-%m-%d').date()
 			timeRecord[date] = {}
 			for time, chargeNumber in sorted(records.items()):
-				project = projectMap[str(chargeNumber)]
-				dtTime = dt.datetime.fromtimestamp(float(time))
-				timeRecord[date][dtTime] = project
-				if chargeNumber != "0":
-					project.addHours(dtTime - prevTime, date)
-				prevTime = dtTime
-				prevTime = max(prevTime, prevTime)
+				timeRecord[date][dt.datetime.fromtimestamp(float(time))] = projectMap[str(chargeNumber)]
+		prevTime = recomputeHours(timeRecord)
 		recordHoursPath = data['recordHoursPath']
 		return {'dailyHours':dailyHours, 
 				'projects':projects, 
@@ -264,18 +561,12 @@ class v1_2(BaseVersion):
 			projectMap[chargeNumber] = project
 		
 		timeRecord = {}
-		prevTime = dt.datetime.fromtimestamp(0)
 		for dateStr, records in sorted(data['records'].items()):
 			date = dt.datetime.strptime(dateStr, '%Y-%m-%d').date()
 			timeRecord[date] = {}
 			for time, chargeNumber in sorted(records.items()):
-				project = projectMap[str(chargeNumber)]
-				dtTime = dt.datetime.fromtimestamp(float(time))
-				timeRecord[date][dtTime] = project
-				if chargeNumber != "0":
-					project.addHours(dtTime - prevTime, date)
-				prevTime = dtTime
-				prevTime = max(prevTime, prevTime)
+				timeRecord[date][dt.datetime.fromtimestamp(float(time))] = projectMap[str(chargeNumber)]
+		prevTime = recomputeHours(timeRecord)
 		recordHoursPath = data['recordHoursPath']
 		return {'dailyHours':dailyHours, 
 				'projects':projects, 
@@ -284,28 +575,59 @@ class v1_2(BaseVersion):
 				'arriveProject':arriveProject,
 				'recordHoursPath':recordHoursPath}
 
+	@classmethod
+	def toDict(self, **kwargs):
+		raise NotImplementedError()
+
+	@classmethod
+	def version(self):
+		return 1.2
+
+class v2_2(BaseVersion):
+	@classmethod
+	def fromDict(self, serialData):
+		assert(isinstance(serialData, dict))
+		assert('version' in serialData)
+		assert(float(serialData['version']) == 2.2)
+		return readManifest(serialData)
+
 	@classmethod
 	def toDict(self, **kwargs):
 		dailyHours = kwargs['dailyHours']
 		projects = kwargs['projects']
 		timeRecord = kwargs['timeRecord']
 		recordHoursPath = kwargs['recordHoursPath']
+		settings = kwargs['settings']
+		months = kwargs['months']
+		unloadedMonths = kwargs.get('unloadedMonths', ())
 		data = {}
 		data['projects'] = {}
 		for project in projects:
 			data['projects'][project.chargeNumber] = {'name': project.name, 
 				'billable': project.isBillable, 'sort': project.sortIdx}
 
-		data['records'] = {}
-		for date, records in timeRecord.items():
-			data['records'][date.isoformat()] = {}
-			for time, project in records.items():
-				data['records'][date.isoformat()][dt.datetime.timestamp(time)] = project.chargeNumber
+		monthDays = {}
+		for date, dayRecord in timeRecord.items():
+			monthDays.setdefault(monthKey(date), {})[date] = dayRecord
+		data['months'] = sorted(set(monthDays.keys()) | set(unloadedMonths))
+		data['shards'] = {}
+		for month in months:
+			if month not in monthDays:
+				continue
+			# Records are streamed from the days by writeShard
+			shard = {'month': month, 'version': 2.2}
+			shard['days'] = monthDays[month]
+			shard['hours'] = {}
+			for date, dayRecord in monthDays[month].items():
+				shard['hours'][date.isoformat()] = {project.chargeNumber: project.hours[date]
+					for project in projects if date in project.hours}
+			data['shards'][month] = shard
 		data['dailyHours'] = dailyHours
 		data['recordHoursPath'] = recordHoursPath
-		data['version'] = 1.2
+		data['settings'] = settings
+		data['version'] = 2.2
 		return data
 
 	@classmethod
 	def version(self):
-		return 1.2
\ No newline at end of file
+		return 2.2
\ No newline at end of file
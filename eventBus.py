@@ -0,0 +1,60 @@
+import collections
+import logging
+
+PunchAdded = collections.namedtuple('PunchAdded', ['time', 'project'])
+DayRecomputed = collections.namedtuple('DayRecomputed', ['dates', 'projects'])
+ProjectAdded = collections.namedtuple('ProjectAdded', ['project'])
+SettingsChanged = collections.namedtuple('SettingsChanged', ['keys'])
+
+EVENT_TYPES = (PunchAdded, DayRecomputed, ProjectAdded, SettingsChanged)
+
+
+class Subscription():
+    # With a scheduler such as widget.after_idle, events are queued and
+    # handed to the callback as one list per scheduled tick
+    def __init__(self, bus, func, eventTypes, scheduler):
+        self.bus = bus
+        self.func = func
+        self.eventTypes = tuple(eventTypes)
+        self.scheduler = scheduler
+        self.pending = []
+
+    def deliver(self, event):
+        if not isinstance(event, self.eventTypes):
+            return
+        if self.scheduler is None:
+            self.func(event)
+            return
+        self.pending.append(event)
+        if len(self.pending) == 1:
+            self.scheduler(self.flush)
+
+    def flush(self):
+        events = self.pending
+        self.pending = []
+        if len(events) > 0:
+            self.func(events)
+
+    def cancel(self):
+        self.bus.unsubscribe(self)
+
+
+class EventBus():
+    def __init__(self):
+        self.__log = logging.getLogger("chargeNumberTracker.EventBus")
+        self.subscriptions = []
+
+    def subscribe(self, func, eventTypes=EVENT_TYPES, coalesce=None):
+        self.__log.debug("Adding subscriber")
+        subscription = Subscription(self, func, eventTypes, coalesce)
+        self.subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.__log.debug("Removing subscriber")
+        if subscription in self.subscriptions:
+            self.subscriptions.remove(subscription)
+
+    def publish(self, event):
+        for subscription in list(self.subscriptions):
+            subscription.deliver(event)
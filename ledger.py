@@ -0,0 +1,139 @@
+import numpy as np
+import datetime as dt
+import billingRules
+
+
+class BalanceLedger():
+    # Running flex-time balance from start, kept as per-day worked and
+    # expected hours plus their prefix sums so that any range is two lookups
+    GROWTH = 64
+    FIELDS = ('start', 'weekdayHours', 'holidays', 'periodTargets',
+              'openingBalance', 'enabled')
+
+    def __init__(self, start, weekdayHours=(8, 8, 8, 8, 8, 0, 0), holidays=(),
+                 periodTargets=None, openingBalance=0.0, enabled=False,
+                 rules=billingRules.DEFAULT_RULES):
+        assert(len(weekdayHours) == 7)
+        self.start = start
+        self.weekdayHours = [float(hours) for hours in weekdayHours]
+        self.holidays = frozenset(holidays)
+        self.periodTargets = {} if periodTargets is None else dict(periodTargets)
+        self.openingBalance = float(openingBalance)
+        self.enabled = enabled
+        self.rules = rules
+        self.clear()
+
+    @classmethod
+    def fromDict(cls, data, dailyHours, rules=billingRules.DEFAULT_RULES, start=None):
+        # start defaults to today, days before it are never owed
+        kwargs = {'start': dt.datetime.today().date() if start is None else start,
+                  'weekdayHours': [dailyHours] * 5 + [0, 0]}
+        # Keys written by newer versions are ignored
+        kwargs.update((key, value) for key, value in data.items() if key in cls.FIELDS)
+        if isinstance(kwargs['start'], str):
+            kwargs['start'] = dt.date.fromisoformat(kwargs['start'])
+        kwargs['holidays'] = [dt.date.fromisoformat(date) if isinstance(date, str)
+                              else date for date in kwargs.get('holidays', [])]
+        kwargs['periodTargets'] = {
+            dt.date.fromisoformat(date) if isinstance(date, str) else date: float(hours)
+            for date, hours in kwargs.get('periodTargets', {}).items()}
+        return cls(rules=rules, **kwargs)
+
+    def toDict(self):
+        return {'start': self.start.isoformat(),
+                'weekdayHours': self.weekdayHours,
+                'holidays': sorted(date.isoformat() for date in self.holidays),
+                'periodTargets': {date.isoformat(): hours for date, hours
+                                  in sorted(self.periodTargets.items())},
+                'openingBalance': self.openingBalance,
+                'enabled': self.enabled}
+
+    def clear(self):
+        self.days = 0
+        self.worked = np.zeros(self.GROWTH)
+        self.expected = np.zeros(self.GROWTH)
+        # workedSum[i] is the total of the first i days
+        self.workedSum = np.zeros(self.GROWTH + 1)
+        self.expectedSum = np.zeros(self.GROWTH + 1)
+
+    def __weekdayHours(self, date):
+        if date in self.holidays:
+            return 0.0
+        return self.weekdayHours[date.weekday()]
+
+    def expectedHours(self, date):
+        # A period target replaces the weekday hours of its period and is
+        # spread over the period's working days in the same proportion
+        dates = self.rules.periodDates(date)
+        if dates[0] not in self.periodTargets:
+            return self.__weekdayHours(date)
+        weights = [self.__weekdayHours(periodDate) for periodDate in dates]
+        if sum(weights) == 0:
+            return self.periodTargets[dates[0]] / len(dates)
+        return self.periodTargets[dates[0]] * \
+            self.__weekdayHours(date) / sum(weights)
+
+    def __index(self, date):
+        return (date - self.start).days
+
+    def __extend(self, end):
+        # Days are only ever appended, capacity doubles so this is amortized
+        # O(1) per new day
+        days = self.__index(end) + 1
+        if days <= self.days:
+            return
+        if days > len(self.worked):
+            capacity = max(days, 2 * len(self.worked))
+            for name in ('worked', 'expected'):
+                array = np.zeros(capacity)
+                array[:self.days] = getattr(self, name)[:self.days]
+                setattr(self, name, array)
+            for name in ('workedSum', 'expectedSum'):
+                array = np.zeros(capacity + 1)
+                array[:self.days + 1] = getattr(self, name)[:self.days + 1]
+                setattr(self, name, array)
+        self.expected[self.days:days] = [
+            self.expectedHours(self.start + dt.timedelta(days=idx))
+            for idx in range(self.days, days)]
+        self.worked[self.days:days] = 0
+        self.workedSum[self.days + 1:days + 1] = self.workedSum[self.days]
+        self.expectedSum[self.days + 1:days + 1] = self.expectedSum[self.days] + \
+            np.cumsum(self.expected[self.days:days])
+        self.days = days
+
+    def rebuild(self, dates, hours, end):
+        self.clear()
+        self.__extend(end)
+        for date, dayHours in zip(dates, hours):
+            if self.start <= date <= end:
+                self.worked[self.__index(date)] = dayHours
+        self.workedSum[1:self.days + 1] = np.cumsum(self.worked[:self.days])
+
+    def setWorked(self, date, hours):
+        # O(1) for the last day, otherwise the later prefix sums are shifted
+        # by one vectorized add
+        if date < self.start:
+            return
+        self.__extend(date)
+        idx = self.__index(date)
+        delta = hours - self.worked[idx]
+        if delta != 0:
+            self.worked[idx] = hours
+            self.workedSum[idx + 1:self.days + 1] += delta
+
+    def __clip(self, date):
+        return min(max(self.__index(date) + 1, 0), self.days)
+
+    def workedHours(self, start, end):
+        return float(self.workedSum[self.__clip(end)] -
+                     self.workedSum[self.__clip(start - dt.timedelta(days=1))])
+
+    def expectedTotal(self, start, end):
+        self.__extend(end)
+        return float(self.expectedSum[self.__clip(end)] -
+                     self.expectedSum[self.__clip(start - dt.timedelta(days=1))])
+
+    def balance(self, end):
+        # Balance at the end of the given day, positive means hours ahead
+        return self.openingBalance + self.workedHours(self.start, end) - \
+            self.expectedTotal(self.start, end)
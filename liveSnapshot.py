@@ -0,0 +1,340 @@
+import datetime as dt
+import json
+import logging
+import os
+import re
+import struct
+import threading
+import time
+import numpy as np
+import records
+import timeZones
+
+# File layout: MAGIC, little-endian uint64 header length, JSON header, then
+# every column as raw little-endian data aligned to ALIGN bytes.  Each
+# version is its own file, FILE_NAME names the current one, so a file is
+# never replaced while a reader has it mapped (which Windows refuses)
+MAGIC = b'CNTSNAP1'
+ALIGN = 64
+FILE_NAME = 'snapshot.json'
+DATA_PATTERN = re.compile(r'^snapshot-(\d+)\.bin$')
+# Versions kept besides the current one, for readers between the pointer
+# and the file
+KEEP_VERSIONS = 1
+REPLACE_RETRIES = 5
+# Seconds between writes, flushes in between are folded into the next one
+MIN_INTERVAL = 2.0
+
+
+# punchProject of a project missing from the snapshot's list
+MISSING = 0xFFFF
+
+
+def dataName(version):
+    return 'snapshot-%08d.bin' % (version)
+
+
+def align(size):
+    return (size + ALIGN - 1) // ALIGN * ALIGN
+
+
+def monthColumns(snapshot, days, dates):
+    # Punches and raw hours of one month.  Days index their own project
+    # table, which may be a previous tracker's and is only read here
+    # through its locked copy()
+    localIdx = {project: idx for idx, project in enumerate(snapshot.projects)}
+    tables = {}
+    for day in days:
+        tables.setdefault(id(day.table), (day.table, []))[1].append(day)
+    punchTime = [np.zeros(0, dtype=np.int64)]
+    punchProject = [np.zeros(0, dtype=np.uint16)]
+    for table, tableDays in tables.values():
+        # A table may list projects these days never use, only a punch of a
+        # project the snapshot does not know is an error
+        lookup = np.array([localIdx.get(project, MISSING) for project in table.copy()],
+                          dtype=np.uint16)
+        punchTime.extend(np.frombuffer(day.times, dtype=np.int64) for day in tableDays)
+        punchProject.append(lookup[np.concatenate(
+            [np.frombuffer(day.projects, dtype=np.uint16) for day in tableDays] +
+            [np.zeros(0, dtype=np.uint16)])])
+        if np.any(punchProject[-1] == MISSING):
+            raise ValueError("Punches of a project missing from the snapshot")
+    return np.concatenate(punchTime), np.concatenate(punchProject), \
+        snapshot.getHoursMatrix(dates)
+
+
+class ColumnCache():
+    # Columns of each month by month index, with the day records and
+    # project month maps they were built from
+    def __init__(self):
+        self.projects = None
+        self.months = {}
+
+
+def buildColumns(snapshot, cache=None):
+    # punchTime is epoch microseconds as stored in DayRecord, punchProject
+    # and the second axis of dayHours/dayBilled index header['projects'].
+    # cache keeps each month's columns with the day records and project
+    # month maps they came from, which the tracker replaces rather than
+    # changes once shared, so only months changed since are rebuilt
+    if cache is None:
+        cache = ColumnCache()
+    if cache.projects != snapshot.projects:
+        cache.projects = snapshot.projects
+        cache.months = {}
+    monthDays = {}
+    for date, day in snapshot.days.items():
+        monthDays.setdefault(records.monthIndex(date), []).append((date, day))
+    monthHours = [hours.months for hours in snapshot.projectHours.values()]
+    months = sorted(set(monthDays).union(*monthHours))
+    blocks = []
+    for month in months:
+        days = sorted(monthDays.get(month, []), key=lambda item: item[0])
+        source = [day for _, day in days] + [hours.get(month) for hours in monthHours]
+        cached = cache.months.get(month)
+        if cached is None or len(cached[0]) != len(source) or \
+                any(old is not new for old, new in zip(cached[0], source)):
+            dates = sorted(set(date for date, _ in days).union(
+                *[hours.get(month, {}) for hours in monthHours]))
+            cached = (source, dates) + monthColumns(
+                snapshot, [day for _, day in days], dates)
+            cache.months[month] = cached
+        blocks.append(cached)
+    cache.months = {month: cache.months[month] for month in months}
+
+    punchTime = np.concatenate([block[2] for block in blocks] + [np.zeros(0, dtype=np.int64)])
+    punchProject = np.concatenate([block[3] for block in blocks] +
+                                  [np.zeros(0, dtype=np.uint16)])
+    order = np.argsort(punchTime, kind='stable')
+    dates = [date for block in blocks for date in block[1]]
+    hours = np.concatenate([block[4] for block in blocks] +
+                           [np.zeros((len(snapshot.projects), 0))], axis=1)
+    # Billing rounds per period, across months, but is vectorised
+    billed = snapshot.billingRules.apply(
+        hours, [snapshot.billingRules.isBillable(project) for project in snapshot.projects],
+        dates)
+    return {'punchTime': punchTime[order].astype('<i8'),
+            'punchProject': punchProject[order].astype('<u2'),
+            'dayOrdinal': np.array([date.toordinal() for date in dates], dtype='<i4'),
+            'dayHours': np.ascontiguousarray(hours.T, dtype='<f8'),
+            'dayBilled': np.ascontiguousarray(billed.T, dtype='<f8')}
+
+
+def readHeader(file):
+    if file.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not a snapshot file")
+    headerLength, = struct.unpack('<Q', file.read(8))
+    return json.loads(file.read(headerLength).decode('utf-8')), \
+        align(len(MAGIC) + 8 + headerLength)
+
+
+def readPointer(path):
+    with open(path, 'r') as file:
+        return json.load(file)
+
+
+def replaceRetrying(source, path):
+    # Windows refuses while a reader has path open, which is only briefly
+    for attempt in range(REPLACE_RETRIES):
+        try:
+            os.replace(source, path)
+            return
+        except PermissionError:
+            if attempt == REPLACE_RETRIES - 1:
+                raise
+            time.sleep(0.05 * (attempt + 1))
+
+
+def writePointer(path, version):
+    with open(path + '.tmp', 'w') as file:
+        json.dump({'version': version, 'file': dataName(version)}, file)
+    replaceRetrying(path + '.tmp', path)
+
+
+def removeOldVersions(directory, version):
+    names = os.listdir(directory)
+    for name in names:
+        match = DATA_PATTERN.match(name)
+        if (match is not None and int(match.group(1)) < version - KEEP_VERSIONS) or \
+                name == 'snapshot.bin':
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                # Still mapped on Windows, the next publish tries again
+                pass
+
+
+def writeSnapshot(path, header, columns):
+    layout = {}
+    offset = 0
+    for name, column in columns.items():
+        layout[name] = {'dtype': column.dtype.str, 'shape': list(column.shape),
+                        'offset': offset}
+        offset += align(column.nbytes)
+    header = dict(header, columns=layout)
+    headerBytes = json.dumps(header, sort_keys=True).encode('utf-8')
+    dataStart = align(len(MAGIC) + 8 + len(headerBytes))
+    with open(path + '.tmp', 'wb') as file:
+        file.write(MAGIC)
+        file.write(struct.pack('<Q', len(headerBytes)))
+        file.write(headerBytes)
+        for name, column in columns.items():
+            file.seek(dataStart + layout[name]['offset'])
+            file.write(column.tobytes())
+        file.truncate(dataStart + offset)
+    # A new name, so nothing that is mapped is replaced
+    os.replace(path + '.tmp', path)
+
+
+class SnapshotPublisher():
+    # Writes are done on a worker thread from a TrackerSnapshot, only the
+    # newest pending snapshot is written and at most one every interval
+    # seconds, except when closing
+    def __init__(self, path, interval=MIN_INTERVAL):
+        self.__log = logging.getLogger("chargeNumberTracker.SnapshotPublisher")
+        self.path = path
+        self.directory = os.path.dirname(path)
+        # Past every version on disk, so a new file never takes a used name
+        self.version = max([int(match.group(1)) for match in
+                            map(DATA_PATTERN.match, os.listdir(self.directory))
+                            if match is not None], default=0)
+        if os.path.isfile(path):
+            try:
+                self.version = max(self.version, readPointer(path)['version'])
+            except (OSError, ValueError, KeyError) as e:
+                self.__log.warning("Ignoring unreadable snapshot pointer: %s" % (e))
+        self.interval = interval
+        self.lastWrite = float('-inf')
+        self.cache = ColumnCache()
+        self.pending = None
+        self.closed = False
+        self.condition = threading.Condition()
+        self.worker = None
+
+    def publish(self, snapshot):
+        with self.condition:
+            self.pending = snapshot
+            if self.worker is None:
+                self.worker = threading.Thread(target=self.__run, daemon=True,
+                                               name="SnapshotPublisher")
+                self.worker.start()
+            self.condition.notify()
+
+    def __run(self):
+        while True:
+            with self.condition:
+                while self.pending is None and not self.closed:
+                    self.condition.wait()
+                while not self.closed and time.monotonic() < self.lastWrite + self.interval:
+                    self.condition.wait(self.lastWrite + self.interval - time.monotonic())
+                if self.pending is None:
+                    return
+                snapshot = self.pending
+                self.pending = None
+            try:
+                self.write(snapshot)
+            except Exception as e:
+                self.__log.warning("Failed to publish snapshot: %s" % (e))
+            self.lastWrite = time.monotonic()
+
+    def write(self, snapshot):
+        self.version += 1
+        header = {'version': self.version,
+                  'created': dt.datetime.now().isoformat(),
+                  'complete': snapshot.complete,
+                  'dailyHours': snapshot.dailyHours,
+                  'zone': snapshot.zone,
+                  'projects': [{'chargeNumber': project.chargeNumber,
+                                'name': project.name,
+                                'billable': snapshot.billingRules.isBillable(project)}
+                               for project in snapshot.projects]}
+        writeSnapshot(os.path.join(self.directory, dataName(self.version)),
+                      header, buildColumns(snapshot, self.cache))
+        writePointer(self.path, self.version)
+        removeOldVersions(self.directory, self.version)
+        self.__log.debug("Published snapshot %d" % (self.version))
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        if self.worker is not None:
+            self.worker.join()
+            self.worker = None
+
+
+class SnapshotReader():
+    # Columns are read-only numpy views onto the mapped file, nothing is
+    # parsed or copied beyond the JSON header.  path is the FILE_NAME pointer
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.refresh()
+
+    def refresh(self):
+        # Returns True if a newer snapshot was mapped
+        for attempt in range(REPLACE_RETRIES):
+            pointer = readPointer(self.path)
+            if pointer['file'] == self.file:
+                return False
+            try:
+                self.__map(pointer['file'])
+                return True
+            except FileNotFoundError:
+                # Removed by a publisher more than KEEP_VERSIONS ahead
+                if attempt == REPLACE_RETRIES - 1:
+                    raise
+
+    def __map(self, name):
+        path = os.path.join(os.path.dirname(self.path), name)
+        with open(path, 'rb') as file:
+            header, dataStart = readHeader(file)
+        data = np.memmap(path, dtype=np.uint8, mode='r')
+        columns = {}
+        for name, layout in header['columns'].items():
+            dtype = np.dtype(layout['dtype'])
+            start = dataStart + layout['offset']
+            count = int(np.prod(layout['shape']))
+            columns[name] = data[start:start + count * dtype.itemsize].view(
+                dtype).reshape(layout['shape'])
+        self.header = header
+        self.columns = columns
+        self.file = name
+
+    @property
+    def version(self):
+        return self.header['version']
+
+    @property
+    def projects(self):
+        return self.header['projects']
+
+    def __dayRange(self, start, end):
+        ordinals = self.columns['dayOrdinal']
+        first = 0 if start is None else np.searchsorted(ordinals, start.toordinal())
+        last = len(ordinals) if end is None else \
+            np.searchsorted(ordinals, end.toordinal(), side='right')
+        return first, last
+
+    def punches(self, start=None, end=None):
+        # Punches on dates start through end in the tracker's zone, as
+        # (epoch microseconds, project index) arrays
+        times = self.columns['punchTime']
+        zone = self.header.get('zone')
+        first = 0 if start is None else np.searchsorted(
+            times, timeZones.toUtc(dt.datetime.combine(start, dt.time()), zone))
+        last = len(times) if end is None else np.searchsorted(
+            times, timeZones.toUtc(dt.datetime.combine(
+                end + dt.timedelta(days=1), dt.time()), zone))
+        return times[first:last], self.columns['punchProject'][first:last]
+
+    def dayTotals(self, start=None, end=None, billed=False):
+        # Returns (date ordinals, days x projects hours) for start through end
+        first, last = self.__dayRange(start, end)
+        column = self.columns['dayBilled' if billed else 'dayHours']
+        return self.columns['dayOrdinal'][first:last], column[first:last]
+
+    def projectHours(self, chargeNumber, start=None, end=None, billed=False):
+        idx = [project['chargeNumber'] for project in self.projects].index(chargeNumber)
+        ordinals, hours = self.dayTotals(start, end, billed)
+        return ordinals, hours[:, idx]
@@ -0,0 +1,81 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+
+DEFAULT_SETTINGS = {'level': 'INFO',
+                    'maxBytes': 1024 * 1024,
+                    'backupCount': 5,
+                    'intervalHours': 24}
+
+_listener = None
+_fileHandler = None
+
+
+class SizedTimedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    # Rolls over when the file would exceed maxBytes or when the interval
+    # has elapsed, whichever comes first
+    def __init__(self, filename, maxBytes=0, backupCount=0, intervalHours=0,
+                 encoding=None):
+        super().__init__(filename, maxBytes=maxBytes, backupCount=backupCount,
+                         encoding=encoding, delay=True)
+        self.setInterval(intervalHours)
+
+    def setInterval(self, intervalHours):
+        self.interval = intervalHours * 60 * 60
+        self.rolloverAt = time.time() + self.interval
+
+    def shouldRollover(self, record):
+        if self.interval > 0 and time.time() >= self.rolloverAt:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self.rolloverAt = time.time() + self.interval
+
+
+def startLogging(logName, settings=DEFAULT_SETTINGS):
+    global _listener, _fileHandler
+    formatter = logging.Formatter(
+        '%(asctime)s.%(msecs)03d: %(levelname)s:%(name)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+    consoleOutput = logging.StreamHandler(sys.stdout)
+    consoleOutput.setLevel(logging.WARNING)
+    consoleOutput.setFormatter(formatter)
+
+    _fileHandler = SizedTimedRotatingFileHandler(logName)
+    _fileHandler.setFormatter(formatter)
+    applySettings(settings)
+
+    # The calling thread only enqueues the record, rotation and file I/O
+    # happen on the listener thread
+    logQueue = queue.SimpleQueue()
+    logger = logging.getLogger()
+    logger.addHandler(logging.handlers.QueueHandler(logQueue))
+    _listener = logging.handlers.QueueListener(
+        logQueue, consoleOutput, _fileHandler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stopLogging)
+
+
+def applySettings(settings):
+    merged = DEFAULT_SETTINGS.copy()
+    merged.update(settings)
+    if _fileHandler is None:
+        return
+    _fileHandler.setLevel(merged['level'])
+    # Records below every handler's level are dropped before being queued
+    logging.getLogger().setLevel(min(_fileHandler.level, logging.WARNING))
+    _fileHandler.maxBytes = int(merged['maxBytes'])
+    _fileHandler.backupCount = int(merged['backupCount'])
+    _fileHandler.setInterval(float(merged['intervalHours']))
+
+
+def stopLogging():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
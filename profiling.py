@@ -0,0 +1,108 @@
+import cProfile
+import datetime as dt
+import functools
+import logging
+import os
+import time
+import tracemalloc
+
+ENV_VAR = 'CHARGE_NUMBER_PROFILE'
+DEFAULT_DURATION = 60
+
+
+def durationFromEnvironment():
+    value = os.environ.get(ENV_VAR)
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return DEFAULT_DURATION
+
+
+class Profiler():
+    # Methods are only wrapped while a capture is running, so nothing is
+    # paid when profiling is off.  scheduler(ms, func), such as widget.after,
+    # ends a capture on time even if no wrapped method is called
+    def __init__(self, outputDir, targets, scheduler=None):
+        self.__log = logging.getLogger("chargeNumberTracker.Profiler")
+        self.outputDir = outputDir
+        self.targets = targets
+        self.profile = None
+        self.deadline = None
+        self.depth = 0
+        self.originals = []
+        self.startedTracemalloc = False
+        self.scheduler = scheduler
+
+    def isRunning(self):
+        return self.profile is not None
+
+    def start(self, duration=DEFAULT_DURATION):
+        if self.isRunning():
+            return
+        self.__log.warning("Profiling for %.0f s" % (duration))
+        self.profile = cProfile.Profile()
+        self.deadline = time.monotonic() + duration
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.startedTracemalloc = True
+        for owner, name in self.targets:
+            original = owner.__dict__[name]
+            self.originals.append((owner, name, original))
+            setattr(owner, name, self.__wrap(original))
+        if self.scheduler is not None:
+            self.__scheduleStop()
+
+    def setScheduler(self, scheduler):
+        # For a capture started before the GUI existed
+        self.scheduler = scheduler
+        if self.isRunning():
+            self.__scheduleStop()
+
+    def __scheduleStop(self):
+        delay = max(self.deadline - time.monotonic(), 0)
+        self.scheduler(int(delay * 1000) + 1, self.__expire)
+
+    def __expire(self):
+        # A capture restarted since this was scheduled has a later deadline
+        if not self.isRunning() or self.depth > 0:
+            return
+        if time.monotonic() >= self.deadline:
+            self.stop()
+        else:
+            self.__scheduleStop()
+
+    def __wrap(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if self.depth == 0:
+                self.profile.enable()
+            self.depth += 1
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.profile.disable()
+                    if time.monotonic() > self.deadline:
+                        self.stop()
+        return wrapper
+
+    def stop(self):
+        if not self.isRunning():
+            return None
+        for owner, name, original in self.originals:
+            setattr(owner, name, original)
+        self.originals = []
+        basePath = os.path.join(self.outputDir, 'profile-%s' % (
+            dt.datetime.now().strftime('%Y%m%d-%H%M%S')))
+        self.profile.dump_stats(basePath + '.prof')
+        self.profile = None
+        if tracemalloc.is_tracing():
+            tracemalloc.take_snapshot().dump(basePath + '.tracemalloc')
+            if self.startedTracemalloc:
+                tracemalloc.stop()
+                self.startedTracemalloc = False
+        self.__log.warning("Profile written to %s.prof" % (basePath))
+        return basePath
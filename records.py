@@ -0,0 +1,403 @@
+import datetime as dt
+import logging
+import threading
+import zlib
+import sys
+from array import array
+from bisect import bisect_left
+from collections.abc import MutableMapping
+import timeZones
+
+_dates = {}
+
+
+def internDate(date):
+    return _dates.setdefault(date, date)
+
+
+class ProjectTable():
+    # Project -> small index stored in DayRecord.projects.  Indices are only
+    # ever appended, and may be handed out from the history loader thread
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.projects = []
+        self.indices = {}
+
+    def index(self, project):
+        idx = self.indices.get(project)
+        if idx is None:
+            with self.lock:
+                idx = self.indices.get(project)
+                if idx is None:
+                    # Listed before it is indexed, so readers never see a
+                    # dangling index
+                    idx = len(self.projects)
+                    self.projects.append(project)
+                    self.indices[project] = idx
+        return idx
+
+    def __getitem__(self, idx):
+        return self.projects[idx]
+
+    def copy(self):
+        with self.lock:
+            return list(self.projects)
+
+
+_table = ProjectTable()
+
+
+def projectIndex(project):
+    return _table.index(project)
+
+
+def resetProjects():
+    # Called when a tracker loads, so projects of a closed tracker are not
+    # kept alive.  Existing days keep resolving through their own table
+    global _table
+    _table = ProjectTable()
+
+
+def monthKey(date):
+    return '%04d-%02d' % (date.year, date.month)
+
+
+def monthIndex(date):
+    return date.year * 12 + date.month
+
+
+class DayRecord(MutableMapping):
+    # Maps datetime -> Project for one day, stored as parallel sorted arrays
+    # of UTC epoch microseconds and indices into the shared project table.
+    # Keys are naive local times in zone, None being the platform's zone
+    __slots__ = ('times', 'projects', 'zone', 'table')
+
+    def __init__(self, records=(), zone=None):
+        self.times = array('q')
+        self.projects = array('H')
+        self.zone = zone
+        self.table = _table
+        if isinstance(records, DayRecord):
+            self.times.extend(records.times)
+            self.projects.extend(records.projects)
+            self.zone = records.zone
+            self.table = records.table
+            return
+        if hasattr(records, 'items'):
+            records = records.items()
+        for time, project in sorted(records):
+            self[time] = project
+
+    @classmethod
+    def fromEpochs(cls, punches, zone=None):
+        dayRecord = cls(zone=zone)
+        punches = sorted(punches, key=lambda punch: punch[0])
+        dayRecord.times.extend(epoch for epoch, _ in punches)
+        dayRecord.projects.extend(dayRecord.table.index(project) for _, project in punches)
+        return dayRecord
+
+    def lastTime(self):
+        if len(self.times) == 0:
+            return None
+        return timeZones.toLocal(self.times[-1], self.zone)
+
+    def __find(self, time):
+        epoch = timeZones.toUtc(time, self.zone)
+        idx = bisect_left(self.times, epoch)
+        if idx < len(self.times) and self.times[idx] == epoch:
+            return idx
+        raise KeyError(time)
+
+    def __getitem__(self, time):
+        return self.table[self.projects[self.__find(time)]]
+
+    def __setitem__(self, time, project):
+        self.setEpoch(timeZones.toUtc(time, self.zone), project)
+
+    def setEpoch(self, epoch, project):
+        idx = bisect_left(self.times, epoch)
+        if idx < len(self.times) and self.times[idx] == epoch:
+            self.projects[idx] = self.table.index(project)
+        else:
+            self.times.insert(idx, epoch)
+            self.projects.insert(idx, self.table.index(project))
+
+    def __delitem__(self, time):
+        idx = self.__find(time)
+        del self.times[idx]
+        del self.projects[idx]
+
+    def __iter__(self):
+        for epoch in self.times:
+            yield timeZones.toLocal(epoch, self.zone)
+
+    def __len__(self):
+        return len(self.times)
+
+    def __contains__(self, time):
+        try:
+            self.__find(time)
+            return True
+        except KeyError:
+            return False
+
+    def items(self):
+        return [(timeZones.toLocal(epoch, self.zone), self.table[idx])
+                for epoch, idx in zip(self.times, self.projects)]
+
+    def epochItems(self):
+        return [(epoch, self.table[idx])
+                for epoch, idx in zip(self.times, self.projects)]
+
+    def __repr__(self):
+        return 'DayRecord(%r, %r)' % (dict(self.items()), self.zone)
+
+
+class MonthHours(MutableMapping):
+    # Maps date -> hours as one dict per month.  freeze() returns a copy
+    # sharing the month dicts, and either side copies a shared month before
+    # changing it, so a snapshot costs one reference per month
+    __slots__ = ('months', 'shared')
+
+    def __init__(self):
+        self.months = {}
+        self.shared = set()
+
+    def freeze(self):
+        frozen = MonthHours()
+        frozen.months = dict(self.months)
+        frozen.shared = set(self.months)
+        self.shared = set(self.months)
+        return frozen
+
+    def __month(self, date):
+        key = monthIndex(date)
+        if key in self.shared:
+            self.months[key] = dict(self.months[key])
+            self.shared.discard(key)
+        return self.months.setdefault(key, {})
+
+    def __getitem__(self, date):
+        month = self.months.get(monthIndex(date))
+        if month is None:
+            raise KeyError(date)
+        return month[date]
+
+    def get(self, date, default=None):
+        month = self.months.get(monthIndex(date))
+        if month is None:
+            return default
+        return month.get(date, default)
+
+    def __contains__(self, date):
+        month = self.months.get(monthIndex(date))
+        return month is not None and date in month
+
+    def __setitem__(self, date, hours):
+        self.__month(date)[date] = hours
+
+    def __delitem__(self, date):
+        if date not in self:
+            raise KeyError(date)
+        del self.__month(date)[date]
+
+    def __iter__(self):
+        for month in list(self.months.values()):
+            yield from month
+
+    def __len__(self):
+        return sum(len(month) for month in self.months.values())
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+def dayHours(dayRecord):
+    # Time between consecutive punches is charged to the later punch, using
+    # UTC instants so days with a DST change keep their real length
+    if not isinstance(dayRecord, DayRecord):
+        dayRecord = DayRecord(dayRecord)
+    hours = {}
+    punches = dayRecord.epochItems()
+    for (start, _), (end, project) in zip(punches, punches[1:]):
+        hours[project] = hours.get(project, 0) + end - start
+    return {project: dt.timedelta(microseconds=micros)
+            for project, micros in hours.items()}
+
+
+def dayChecksum(dayRecord):
+    if not isinstance(dayRecord, DayRecord):
+        dayRecord = DayRecord(dayRecord)
+    times = dayRecord.times
+    if sys.byteorder != 'little':
+        times = array('q', times)
+        times.byteswap()
+    checksum = zlib.crc32(times.tobytes())
+    checksum = zlib.crc32(','.join([dayRecord.table[idx].chargeNumber
+                                    for idx in dayRecord.projects]).encode('utf-8'), checksum)
+    return '%08x' % (checksum)
+
+
+class TimeRecord(dict):
+    # Maps date -> {datetime: Project}.  The dict itself holds the hot days,
+    # days of archived years are decompressed the first time they are reached
+    # and months still waiting on the background history load are read
+    # through monthLoader if something needs them first
+    def __init__(self, days=(), archive=None, loader=None, serializer=None,
+                 unloadedMonths=(), monthLoader=None, lock=None, zone=None):
+        super().__init__()
+        self.__log = logging.getLogger("chargeNumberTracker.TimeRecord")
+        # Zone given to days created from now on
+        self.zone = zone
+        # Lazy loads change the mapping, so they take the owner's write lock
+        self.lock = lock if lock is not None else threading.RLock()
+        self.archive = archive
+        self.loader = loader
+        self.serializer = serializer
+        self.archivedDays = {}
+        self.loadedYears = set()
+        self.dirtyYears = set()
+        self.dirtyMonths = set()
+        self.removedMonths = set()
+        self.changedDates = set()
+        self.unloadedMonths = set(unloadedMonths)
+        self.monthLoader = monthLoader
+        self.__archivedDates = None
+        if hasattr(days, 'items'):
+            days = days.items()
+        for date, dayRecord in days:
+            self[date] = dayRecord
+
+    def __archivedDateSet(self):
+        if self.__archivedDates is None:
+            self.__archivedDates = set()
+            if self.archive is not None:
+                for year in self.archive.years():
+                    self.__archivedDates.update(
+                        dt.datetime.strptime(dateStr, '%Y-%m-%d').date()
+                        for dateStr in self.archive.summary(year)['days'])
+        return self.__archivedDates
+
+    def isArchived(self, date):
+        return not dict.__contains__(self, date) and \
+            date in self.__archivedDateSet()
+
+    def loadMonth(self, month, days=None):
+        with self.lock:
+            if month not in self.unloadedMonths:
+                return
+            if days is None:
+                days = self.monthLoader(month)
+            self.__log.info("Loaded month %s" % (month))
+            self.unloadedMonths.discard(month)
+            for date, dayRecord in days.items():
+                dict.__setitem__(self, internDate(date), dayRecord)
+
+    def loadAll(self):
+        for month in sorted(self.unloadedMonths, reverse=True):
+            self.loadMonth(month)
+
+    def isComplete(self):
+        return len(self.unloadedMonths) == 0
+
+    def __setitem__(self, date, dayRecord):
+        # The rest of the month must be present before its shard is rewritten
+        self.loadMonth(monthKey(date))
+        if not isinstance(dayRecord, DayRecord):
+            dayRecord = DayRecord(dayRecord, zone=self.zone)
+        dict.__setitem__(self, internDate(date), dayRecord)
+        self.dirtyMonths.add(monthKey(date))
+        self.changedDates.add(internDate(date))
+
+    def __contains__(self, date):
+        if dict.__contains__(self, date):
+            return True
+        if monthKey(date) in self.unloadedMonths:
+            self.loadMonth(monthKey(date))
+            return dict.__contains__(self, date)
+        return date in self.__archivedDateSet()
+
+    def __missing__(self, date):
+        if monthKey(date) in self.unloadedMonths:
+            self.loadMonth(monthKey(date))
+            if dict.__contains__(self, date):
+                return dict.__getitem__(self, date)
+        if date not in self.__archivedDateSet():
+            raise KeyError(date)
+        self.loadYear(date.year)
+        return self.archivedDays[date]
+
+    def get(self, date, default=None):
+        if date in self:
+            return self[date]
+        return default
+
+    def archivedYears(self):
+        if self.archive is None:
+            return []
+        return self.archive.years()
+
+    def loadYear(self, year):
+        with self.lock:
+            if year in self.loadedYears or year not in self.archivedYears():
+                return
+            self.__log.info("Loading archived year %d" % (year))
+            self.archivedDays.update(self.loader(self.archive.read(year)))
+            self.loadedYears.add(year)
+
+    def ensureLoaded(self, dates):
+        for month in {monthKey(date) for date in dates}:
+            self.loadMonth(month)
+        for year in {date.year for date in dates}:
+            self.loadYear(year)
+
+    def mutableDay(self, date):
+        # Day records may be shared with snapshots, so writers change a
+        # private copy that replaces the shared one
+        dayRecord = DayRecord(self.get(date, ()), zone=self.zone)
+        if self.isArchived(date):
+            self.archivedDays[date] = dayRecord
+        else:
+            dict.__setitem__(self, internDate(date), dayRecord)
+        return dayRecord
+
+    def discardDay(self, date):
+        # Only for an empty day nothing was saved for yet
+        if dict.__contains__(self, date) and len(dict.__getitem__(self, date)) == 0:
+            dict.__delitem__(self, date)
+
+    def touch(self, date):
+        self.loadMonth(monthKey(date))
+        if self.isArchived(date):
+            self.dirtyYears.add(date.year)
+        else:
+            self.dirtyMonths.add(monthKey(date))
+        self.changedDates.add(internDate(date))
+
+    def markClean(self):
+        self.dirtyMonths = set()
+        self.removedMonths = set()
+
+    def archiveYear(self, year):
+        for month in sorted(self.unloadedMonths):
+            if month.startswith('%04d-' % (year)):
+                self.loadMonth(month)
+        self.loadYear(year)
+        days = {date: dayRecord for date, dayRecord in self.archivedDays.items()
+                if date.year == year}
+        for date in [date for date in dict.keys(self) if date.year == year]:
+            days[date] = self.pop(date)
+            self.dirtyMonths.discard(monthKey(date))
+            self.removedMonths.add(monthKey(date))
+        self.archive.write(year, self.serializer(days))
+        self.archivedDays.update(days)
+        self.loadedYears.add(year)
+        self.dirtyYears.discard(year)
+        self.__archivedDates = None
+
+    def flushArchives(self):
+        for year in sorted(self.dirtyYears):
+            days = {date: dayRecord for date, dayRecord in self.archivedDays.items()
+                    if date.year == year}
+            self.archive.write(year, self.serializer(days))
+        self.dirtyYears = set()
@@ -0,0 +1,195 @@
+from abc import ABC, abstractmethod
+import http.client
+import json
+import logging
+import platform
+import queue
+import shlex
+import subprocess
+import threading
+import urllib.parse
+
+
+def timesheetEntries(hourTracker, dates):
+    # hourTracker may be a TrackerSnapshot, so this can run off the GUI thread
+    projects = [project for project in hourTracker.projects
+                if hourTracker.billingRules.isBillable(project)]
+    billed = hourTracker.getBillableMatrix(dates, projects)
+    entries = []
+    for row, project in enumerate(projects):
+        for col, date in enumerate(dates):
+            if billed[row, col] > 0:
+                entries.append({'date': date.isoformat(),
+                                'chargeNumber': project.chargeNumber,
+                                'name': project.name,
+                                'hours': float(billed[row, col])})
+    return entries
+
+
+def isUrl(path):
+    return urllib.parse.urlparse(path).scheme in ('http', 'https')
+
+
+class BaseSubmitter(ABC):
+    @abstractmethod
+    def submit(self, entries):
+        pass
+
+    def close(self):
+        pass
+
+
+class LauncherSubmitter(BaseSubmitter):
+    # Opens the external hour logging application, hours are copied by hand
+    def __init__(self, path):
+        self.path = path
+
+    def submit(self, entries):
+        if platform.system() == 'Windows':
+            subprocess.Popen(shlex.split(self.path, posix=False), shell=True)
+        else:
+            subprocess.Popen(shlex.split(self.path))
+
+
+class SubmissionError(Exception):
+    pass
+
+
+class ConnectionPool():
+    def __init__(self, url, size=4, timeout=10):
+        self.url = urllib.parse.urlparse(url)
+        if self.url.scheme == 'https':
+            self.connectionClass = http.client.HTTPSConnection
+        else:
+            self.connectionClass = http.client.HTTPConnection
+        self.timeout = timeout
+        self.pool = queue.LifoQueue(maxsize=size)
+
+    def get(self):
+        try:
+            return self.pool.get_nowait()
+        except queue.Empty:
+            return self.connectionClass(self.url.netloc, timeout=self.timeout)
+
+    def put(self, connection):
+        try:
+            self.pool.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def close(self):
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class HttpSubmitter(BaseSubmitter):
+    RETRY_STATUS = (408, 429, 500, 502, 503, 504)
+    SETTINGS = ('batchSize', 'maxRetries', 'backoff', 'poolSize', 'timeout',
+                'headers')
+
+    def __init__(self, url, batchSize=50, maxRetries=5, backoff=1.0,
+                 poolSize=4, timeout=10, headers=None, onResult=None):
+        self.__log = logging.getLogger("chargeNumberTracker.HttpSubmitter")
+        self.url = url
+        parsedUrl = urllib.parse.urlparse(url)
+        self.path = parsedUrl.path or '/'
+        if parsedUrl.query:
+            self.path += '?' + parsedUrl.query
+        self.poolSize = poolSize
+        self.batchSize = batchSize
+        self.maxRetries = maxRetries
+        self.backoff = backoff
+        self.headers = {'Content-Type': 'application/json'}
+        if headers is not None:
+            self.headers.update(headers)
+        self.onResult = onResult
+        self.pool = ConnectionPool(url, poolSize, timeout)
+        self.batches = queue.Queue()
+        self.results = queue.Queue()
+        self.workers = []
+        self.stopping = threading.Event()
+
+    @classmethod
+    def fromSettings(cls, url, settings, **kwargs):
+        # Keys written by newer versions are ignored
+        kwargs.update({key: value for key, value in settings.items()
+                       if key in cls.SETTINGS})
+        return cls(url, **kwargs)
+
+    def submit(self, entries):
+        for idx in range(0, len(entries), self.batchSize):
+            self.batches.put(entries[idx:idx + self.batchSize])
+        # One worker per pooled connection
+        while len(self.workers) < self.poolSize:
+            worker = threading.Thread(target=self.__run, daemon=True,
+                                      name="HttpSubmitter-%d" % (len(self.workers)))
+            worker.start()
+            self.workers.append(worker)
+
+    def __run(self):
+        while True:
+            batch = self.batches.get()
+            if batch is None:
+                self.batches.task_done()
+                return
+            try:
+                if self.stopping.is_set():
+                    raise SubmissionError("Submitter closed")
+                self.post(batch)
+                result = (batch, None)
+            except Exception as e:
+                self.__log.warning("Failed to submit batch: %s" % (e))
+                result = (batch, e)
+            self.results.put(result)
+            if self.onResult is not None:
+                self.onResult(*result)
+            self.batches.task_done()
+
+    def post(self, batch):
+        body = json.dumps({'entries': batch}).encode('utf-8')
+        for attempt in range(self.maxRetries + 1):
+            # close() cuts the backoff short, the last error is reported
+            if attempt > 0 and self.stopping.wait(self.backoff * 2 ** (attempt - 1)):
+                break
+            connection = self.pool.get()
+            try:
+                connection.request('POST', self.path, body, self.headers)
+                response = connection.getresponse()
+                response.read()
+            except (http.client.HTTPException, OSError) as e:
+                connection.close()
+                self.__log.info("Attempt %d failed: %s" % (attempt, e))
+                error = e
+                continue
+            self.pool.put(connection)
+            if 200 <= response.status < 300:
+                return response.status
+            error = SubmissionError("HTTP %d %s" % (response.status,
+                                                    response.reason))
+            if response.status not in self.RETRY_STATUS:
+                break
+            self.__log.info("Attempt %d failed: %s" % (attempt, error))
+        raise error
+
+    def join(self):
+        self.batches.join()
+
+    def close(self):
+        # Called from the GUI thread, so nothing here waits on the network.
+        # Batches still queued are reported as failed, the workers exit and
+        # the pool is closed on a separate thread once they have
+        self.stopping.set()
+        workers = self.workers
+        self.workers = []
+        for worker in workers:
+            self.batches.put(None)
+        threading.Thread(target=self.__drain, args=(workers,), daemon=True,
+                         name="HttpSubmitter-close").start()
+
+    def __drain(self, workers):
+        for worker in workers:
+            worker.join()
+        self.pool.close()
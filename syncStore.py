@@ -0,0 +1,169 @@
+import collections
+import datetime as dt
+import glob
+import json
+import logging
+import os
+import uuid
+import dataStore
+import timeZones
+from records import dayChecksum
+
+SyncConflict = collections.namedtuple(
+    'SyncConflict', ['time', 'localChargeNumber', 'peerChargeNumber',
+                     'chargeNumber'])
+SyncResult = collections.namedtuple(
+    'SyncResult', ['pulledDays', 'pushedDays', 'conflicts'])
+
+
+def writeJsonAtomic(path, data):
+    with open(path + '.tmp', 'w') as file:
+        json.dump(data, file, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+class SyncStore():
+    # Every machine appends numbered change files holding only the days it
+    # changed to <folder>/<machineId>/ and remembers how far it has read
+    # each peer's log.  Days carry the checksum they were based on, so a
+    # side that has not touched a day simply takes the other's version.
+    def __init__(self, dataDir, folder):
+        self.__log = logging.getLogger("chargeNumberTracker.SyncStore")
+        self.statePath = os.path.join(dataDir, 'sync.json')
+        self.folder = folder
+        self.state = {'machineId': uuid.uuid4().hex, 'seq': 0, 'peers': {},
+                      'synced': {}, 'bootstrapped': False}
+        if os.path.isfile(self.statePath):
+            with open(self.statePath, 'r') as file:
+                self.state.update(json.load(file))
+        self.machineId = self.state['machineId']
+
+    def __outbox(self, machineId):
+        return os.path.join(self.folder, machineId)
+
+    def saveState(self):
+        writeJsonAtomic(self.statePath, self.state)
+
+    def sync(self, hourTracker):
+        pulledDays, conflicts = self.pull(hourTracker)
+        pushedDays = self.push(hourTracker)
+        return SyncResult(pulledDays, pushedDays, conflicts)
+
+    def peers(self):
+        return sorted(os.path.basename(os.path.dirname(head)) for head
+                      in glob.glob(os.path.join(self.folder, '*', 'head.json'))
+                      if os.path.basename(os.path.dirname(head)) != self.machineId)
+
+    def pull(self, hourTracker):
+        synced = self.state['synced']
+        pending = set(hourTracker.timeRecord.changedDates)
+        pulledDays = 0
+        conflicts = []
+        # A peer's changes are not the user's to undo
+        with hourTracker.transaction(undoable=False) as transaction:
+            for peerId in self.peers():
+                with open(os.path.join(self.__outbox(peerId), 'head.json'), 'r') as file:
+                    head = json.load(file)['seq']
+                for seq in range(self.state['peers'].get(peerId, 0) + 1, head + 1):
+                    self.__log.info("Reading %s change %d" % (peerId, seq))
+                    with open(os.path.join(self.__outbox(peerId), '%08d.json' % (seq)), 'r') as file:
+                        change = json.load(file)
+                    for chargeNumber, attr in change['projects'].items():
+                        hourTracker.ensureProject(chargeNumber, attr['name'],
+                                                  attr['billable'], attr['sort'])
+                    projectMap = {project.chargeNumber: project
+                                  for project in hourTracker.projects}
+                    for dateStr, entry in sorted(change['days'].items()):
+                        date = dt.date.fromisoformat(dateStr)
+                        peerDay = dataStore.deserializeDays(
+                            {dateStr: entry['records']}, projectMap,
+                            {dateStr: entry.get('zone')})[date]
+                        localDay = hourTracker.timeRecord.get(date)
+                        localChecksum = None if localDay is None else dayChecksum(localDay)
+                        lastSynced = synced.get(dateStr)
+                        # Pushing skips days whose checksum matches synced,
+                        # so only merged days are sent back
+                        synced[dateStr] = entry['checksum']
+                        pulledDays += 1
+                        if localChecksum == entry['checksum']:
+                            continue
+                        # Merged by instant, wall times repeat when clocks
+                        # fall back and the peer may keep the day in
+                        # another zone
+                        zone = hourTracker.timeRecord.zone if localDay is None else localDay.zone
+                        if localDay is None or localChecksum == entry['base'] or \
+                                (date not in pending and lastSynced == localChecksum):
+                            merged = dict(peerDay.epochItems())
+                        else:
+                            merged = self.__merge(localDay, peerDay, peerId, conflicts)
+                        current = {} if localDay is None else dict(localDay.epochItems())
+                        for epoch in current:
+                            if epoch not in merged:
+                                transaction.delete(timeZones.toLocal(epoch, zone))
+                        for epoch, project in merged.items():
+                            if current.get(epoch) is not project:
+                                transaction.insert(timeZones.toLocal(epoch, zone), project)
+                    self.state['peers'][peerId] = seq
+        self.saveState()
+        return pulledDays, conflicts
+
+    def __merge(self, localDay, peerDay, peerId, conflicts):
+        merged = dict(localDay.epochItems())
+        for epoch, project in peerDay.epochItems():
+            if epoch not in merged:
+                merged[epoch] = project
+            elif merged[epoch] is not project:
+                # The larger machine id wins, so both sides agree
+                if peerId > self.machineId:
+                    winner = project
+                else:
+                    winner = merged[epoch]
+                conflicts.append(SyncConflict(timeZones.toLocal(epoch, localDay.zone),
+                                              merged[epoch].chargeNumber,
+                                              project.chargeNumber,
+                                              winner.chargeNumber))
+                merged[epoch] = winner
+        return merged
+
+    def push(self, hourTracker):
+        synced = self.state['synced']
+        if self.state['bootstrapped']:
+            dates = hourTracker.timeRecord.changedDates
+        else:
+            hourTracker.timeRecord.loadAll()
+            dates = set(dict.keys(hourTracker.timeRecord)) | \
+                hourTracker.timeRecord.changedDates
+        days = {}
+        for date in sorted(dates):
+            dayRecord = hourTracker.timeRecord.get(date)
+            if dayRecord is None:
+                continue
+            checksum = dayChecksum(dayRecord)
+            if synced.get(date.isoformat()) == checksum:
+                continue
+            days[date.isoformat()] = {
+                'records': dataStore.serializeDays({date: dayRecord})[date.isoformat()],
+                'checksum': checksum,
+                'zone': dayRecord.zone,
+                'base': synced.get(date.isoformat())}
+            synced[date.isoformat()] = checksum
+        if len(days) > 0:
+            outbox = self.__outbox(self.machineId)
+            if not os.path.isdir(outbox):
+                os.makedirs(outbox)
+            self.state['seq'] += 1
+            self.__log.info("Writing change %d with %d days" % (self.state['seq'], len(days)))
+            projects = {project.chargeNumber: {'name': project.name,
+                                               'billable': project.isBillable,
+                                               'sort': project.sortIdx}
+                        for project in hourTracker.projects}
+            writeJsonAtomic(os.path.join(outbox, '%08d.json' % (self.state['seq'])),
+                            {'machine': self.machineId, 'seq': self.state['seq'],
+                             'projects': projects, 'days': days})
+            writeJsonAtomic(os.path.join(outbox, 'head.json'),
+                            {'seq': self.state['seq']})
+        hourTracker.timeRecord.changedDates = set()
+        self.state['bootstrapped'] = True
+        self.saveState()
+        hourTracker.flush()
+        return len(days)
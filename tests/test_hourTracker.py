@@ -0,0 +1,62 @@
+import datetime as dt
+import tempfile
+import unittest
+from unittest import mock
+import dataStore
+import chargeNumberTracker
+import records
+import timeZones
+
+ZONE = 'America/New_York'
+
+
+class TestRecordHours(unittest.TestCase):
+    def setUp(self):
+        self.dataDir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dataDir.cleanup)
+        tracker = chargeNumberTracker.HourTracker(self.dataDir.name)
+        tracker.open()
+        tracker.settings['timeZone'] = ZONE
+        tracker.close()
+        self.tracker = self.openTracker()
+
+    def openTracker(self):
+        tracker = chargeNumberTracker.HourTracker(self.dataDir.name)
+        tracker.open()
+        self.addCleanup(tracker.close)
+        return tracker
+
+    def punchAt(self, time, project, zone=ZONE):
+        with mock.patch('timeZones.nowEpoch', return_value=timeZones.toUtc(time, zone)):
+            if project is self.tracker.arriveProject:
+                self.tracker.recordArrive(time)
+            else:
+                self.tracker.recordHours(project)
+
+    def testHoursAcrossDstChange(self):
+        # 00:30 EDT to 03:00 EST is three and a half hours
+        project = self.tracker.ensureProject('100', 'A', True)
+        date = dt.date(2025, 11, 2)
+        self.punchAt(dt.datetime(2025, 11, 2, 0, 30), self.tracker.arriveProject)
+        self.punchAt(dt.datetime(2025, 11, 2, 3, 0), project)
+        self.assertEqual(project.hours[date], 3.5)
+        self.assertEqual(records.dayHours(self.tracker.timeRecord[date])[project],
+                         dt.timedelta(hours=3.5))
+        self.tracker.close()
+        tracker = self.openTracker()
+        reloaded, = [project for project in tracker.projects if project.chargeNumber == '100']
+        self.assertEqual(reloaded.hours[date], 3.5)
+
+    def testPunchFromAnotherZone(self):
+        project = self.tracker.ensureProject('100', 'A', True)
+        date = dt.date(2026, 3, 4)
+        self.punchAt(dt.datetime(2026, 3, 4, 8), self.tracker.arriveProject)
+        # Noon in Los Angeles is 15:00 in New York, where the day is kept
+        self.punchAt(dt.datetime(2026, 3, 4, 12), project, zone='America/Los_Angeles')
+        self.assertEqual(sorted(self.tracker.timeRecord[date].keys()),
+                         [dt.datetime(2026, 3, 4, 8), dt.datetime(2026, 3, 4, 15)])
+        self.assertEqual(project.hours[date], 7)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+import http.server
+import json
+import threading
+import time
+import unittest
+import submission
+
+
+class MockTimesheetServer(http.server.ThreadingHTTPServer):
+    # Answers each POST with the next status in statuses, repeating the
+    # last one, and keeps every batch it was sent
+    def __init__(self, statuses=(200,)):
+        super().__init__(('127.0.0.1', 0), MockTimesheetHandler)
+        self.statuses = list(statuses)
+        self.requests = []
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/timesheet' % (self.server_address[1])
+
+    def nextStatus(self, body):
+        with self.lock:
+            self.requests.append(body)
+            if len(self.statuses) > 1:
+                return self.statuses.pop(0)
+            return self.statuses[0]
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class MockTimesheetHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        status = self.server.nextStatus(body)
+        reply = json.dumps({'status': status}).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def makeEntries(count):
+    return [{'date': '2026-10-%02d' % (idx + 1), 'chargeNumber': '100',
+             'name': 'A', 'hours': 1.0 + idx} for idx in range(count)]
+
+
+def collectResults(submitter, count, timeout=10):
+    results = []
+    deadline = time.monotonic() + timeout
+    while len(results) < count and time.monotonic() < deadline:
+        results.append(submitter.results.get(timeout=deadline - time.monotonic()))
+    return results
+
+
+class TestHttpSubmitter(unittest.TestCase):
+    def startServer(self, statuses=(200,)):
+        server = MockTimesheetServer(statuses)
+        self.addCleanup(server.stop)
+        return server
+
+    def makeSubmitter(self, server, **kwargs):
+        submitter = submission.HttpSubmitter(server.url, **kwargs)
+        self.addCleanup(submitter.close)
+        return submitter
+
+    def testBatches(self):
+        server = self.startServer()
+        submitter = self.makeSubmitter(server, batchSize=2, poolSize=2)
+        entries = makeEntries(5)
+        submitter.submit(entries)
+        submitter.join()
+        results = collectResults(submitter, 3)
+        self.assertEqual([error for _, error in results], [None] * 3)
+        self.assertEqual(len(server.requests), 3)
+        self.assertTrue(all(len(body['entries']) <= 2 for body in server.requests))
+        received = sorted((entry for body in server.requests for entry in body['entries']),
+                          key=lambda entry: entry['date'])
+        self.assertEqual(received, entries)
+
+    def testRetriesWithBackoff(self):
+        server = self.startServer([503, 503, 200])
+        submitter = self.makeSubmitter(server, maxRetries=3, backoff=0.05, poolSize=1)
+        start = time.monotonic()
+        submitter.submit(makeEntries(1))
+        submitter.join()
+        elapsed = time.monotonic() - start
+        (batch, error), = collectResults(submitter, 1)
+        self.assertIsNone(error)
+        self.assertEqual(len(server.requests), 3)
+        # Two retries wait backoff and then twice that
+        self.assertGreaterEqual(elapsed, 0.05 + 0.1)
+
+    def testFinalFailureIsReported(self):
+        server = self.startServer([503])
+        reported = []
+        submitter = self.makeSubmitter(server, maxRetries=2, backoff=0.01, poolSize=1,
+                                       onResult=lambda batch, error: reported.append(error))
+        entries = makeEntries(1)
+        submitter.submit(entries)
+        submitter.join()
+        (batch, error), = collectResults(submitter, 1)
+        self.assertEqual(batch, entries)
+        self.assertIsInstance(error, submission.SubmissionError)
+        self.assertIn('503', str(error))
+        self.assertEqual(len(server.requests), 3)
+        self.assertEqual(reported, [error])
+
+    def testClientErrorIsNotRetried(self):
+        server = self.startServer([400])
+        submitter = self.makeSubmitter(server, maxRetries=3, backoff=0.01, poolSize=1)
+        submitter.submit(makeEntries(1))
+        submitter.join()
+        (batch, error), = collectResults(submitter, 1)
+        self.assertIn('400', str(error))
+        self.assertEqual(len(server.requests), 1)
+
+    def testCloseDoesNotWaitForBackoff(self):
+        server = self.startServer([503])
+        submitter = submission.HttpSubmitter(server.url, maxRetries=5, backoff=30,
+                                             poolSize=1, batchSize=1)
+        submitter.submit(makeEntries(2))
+        deadline = time.monotonic() + 5
+        while len(server.requests) == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        start = time.monotonic()
+        submitter.close()
+        self.assertLess(time.monotonic() - start, 1)
+        results = collectResults(submitter, 2, timeout=5)
+        self.assertEqual(len(results), 2)
+        self.assertTrue(all(error is not None for _, error in results))
+        self.assertEqual(len(server.requests), 1)
+
+    def testFromSettingsIgnoresUnknownKeys(self):
+        submitter = submission.HttpSubmitter.fromSettings(
+            'http://127.0.0.1:1/', {'batchSize': 7, 'futureKey': True})
+        self.assertEqual(submitter.batchSize, 7)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+import datetime as dt
+import unittest
+import records
+import timeZones
+
+ZONE = 'America/New_York'
+
+
+class TestRepeatedHour(unittest.TestCase):
+    # 2025-11-02 01:00-02:00 happens twice in New York, first in EDT
+    def setUp(self):
+        self.first = timeZones.toUtc(dt.datetime(2025, 11, 2, 1, 30), ZONE)
+        self.second = self.first + 60 * 60 * 1000000
+
+    def testLaterInstantGetsFold(self):
+        first = timeZones.toLocal(self.first, ZONE)
+        second = timeZones.toLocal(self.second, ZONE)
+        self.assertEqual((first.fold, second.fold), (0, 1))
+        self.assertEqual(timeZones.toUtc(first, ZONE), self.first)
+        self.assertEqual(timeZones.toUtc(second, ZONE), self.second)
+
+    def testOtherTimesHaveNoFold(self):
+        for time in (dt.datetime(2025, 11, 2, 0, 30), dt.datetime(2025, 11, 2, 3, 0),
+                     dt.datetime(2025, 3, 9, 3, 30), dt.datetime(2025, 7, 1, 1, 30)):
+            local = timeZones.toLocal(timeZones.toUtc(time, ZONE), ZONE)
+            self.assertEqual((local, local.fold), (time, 0))
+
+    def testDeletingSecondPunchKeepsFirst(self):
+        day = records.DayRecord(zone=ZONE)
+        day.setEpoch(self.first, 'arrive')
+        day.setEpoch(self.second, 'work')
+        keys = list(day)
+        self.assertEqual([key.fold for key in keys], [0, 1])
+        del day[keys[1]]
+        self.assertEqual(day.epochItems(), [(self.first, 'arrive')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import datetime as dt
+import functools
+import os
+import time
+from bisect import bisect_right
+import pytz
+
+EPOCH = dt.datetime(1970, 1, 1)
+DAY = 24 * 60 * 60 * 1000000
+# Wide enough that any local time of a day falls in its UTC window
+WINDOW = 14 * 60 * 60 * 1000000
+
+# Offset tables kept, one per zone and UTC day, the rest are recomputed
+OFFSET_TABLES = 4096
+_zones = {}
+
+
+def systemZone():
+    # Zone id of this machine, None falls back to the platform's local time
+    name = os.environ.get('TZ', '').lstrip(':')
+    if name in pytz.all_timezones_set:
+        return name
+    try:
+        with open('/etc/timezone', 'r') as file:
+            name = file.read().strip()
+        if name in pytz.all_timezones_set:
+            return name
+    except OSError:
+        pass
+    try:
+        name = os.path.realpath('/etc/localtime').split('zoneinfo/', 1)[1]
+        if name in pytz.all_timezones_set:
+            return name
+    except (OSError, IndexError):
+        pass
+    return None
+
+
+def nowEpoch():
+    return time.time_ns() // 1000
+
+
+def _zone(name):
+    if name not in _zones:
+        _zones[name] = pytz.timezone(name)
+    return _zones[name]
+
+
+def utcOffset(zone, epoch):
+    # Offset in microseconds at the UTC instant epoch
+    utc = EPOCH + dt.timedelta(microseconds=epoch)
+    if zone is None:
+        local = dt.datetime.fromtimestamp(epoch // 1000000).replace(
+            microsecond=epoch % 1000000)
+    else:
+        local = _zone(zone).fromutc(utc).replace(tzinfo=None)
+    return (local - utc) // dt.timedelta(microseconds=1)
+
+
+def _transitions(zone, start, end, startOffset, endOffset):
+    if startOffset == endOffset:
+        return []
+    if end - start <= 1:
+        return [(end, endOffset)]
+    middle = (start + end) // 2
+    middleOffset = utcOffset(zone, middle)
+    return _transitions(zone, start, middle, startOffset, middleOffset) + \
+        _transitions(zone, middle, end, middleOffset, endOffset)
+
+
+@functools.lru_cache(maxsize=OFFSET_TABLES)
+def offsetTable(zone, dayNumber):
+    # (starts, offsets) covering UTC day dayNumber padded by WINDOW, found
+    # with two lookups unless the offset changes in the window
+    start = dayNumber * DAY - WINDOW
+    end = (dayNumber + 1) * DAY + WINDOW
+    startOffset = utcOffset(zone, start)
+    changes = _transitions(zone, start, end, startOffset,
+                           utcOffset(zone, end))
+    return ([start] + [epoch for epoch, _ in changes],
+            [startOffset] + [offset for _, offset in changes])
+
+
+def localMicros(epoch, zone):
+    starts, offsets = offsetTable(zone, epoch // DAY)
+    if len(offsets) == 1:
+        return epoch + offsets[0]
+    return epoch + offsets[bisect_right(starts, epoch) - 1]
+
+
+def toLocal(epoch, zone):
+    # The later of two instants showing the same wall time, in the hour
+    # repeated when the offset falls back, gets fold=1 so toUtc finds it
+    local = localMicros(epoch, zone)
+    time = EPOCH + dt.timedelta(microseconds=local)
+    _, offsets = offsetTable(zone, epoch // DAY)
+    if len(offsets) > 1 and any(local - offset < epoch and
+                                localMicros(local - offset, zone) == local
+                                for offset in offsets):
+        time = time.replace(fold=1)
+    return time
+
+
+def toUtc(time, zone):
+    # Ambiguous times follow time.fold, and times skipped by a transition
+    # use the offset from before it, as datetime.timestamp does
+    local = (time.replace(tzinfo=None) - EPOCH) // dt.timedelta(microseconds=1)
+    starts, offsets = offsetTable(zone, local // DAY)
+    if len(offsets) == 1:
+        return local - offsets[0]
+    candidates = sorted({local - offset for offset in offsets
+                         if localMicros(local - offset, zone) == local})
+    if len(candidates) == 0:
+        return local - offsets[0]
+    return candidates[-1] if time.fold else candidates[0]